@@ -0,0 +1,159 @@
+import asyncio
+import math
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Longest a request may wait for a slot before it is turned away
+MAX_WAIT_SECONDS = float(os.getenv("ADMISSION_MAX_WAIT_SECONDS", "30"))
+
+class AdmissionRejected(Exception):
+    """
+    Raised when an endpoint is saturated; the client should retry after
+    ``retry_after`` seconds.
+    """
+
+    def __init__(self, endpoint, retry_after):
+        super().__init__(f"{endpoint} is overloaded, retry after {retry_after}s")
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+
+class AdmissionController:
+    """
+    Weighted concurrency limit with a bounded FIFO queue for one endpoint.
+
+    Each request costs some units (at least 1, at most ``capacity``).
+    Requests run while the units in use fit within ``capacity``; the rest
+    wait in line. When ``max_queue`` requests are already waiting, or a
+    request has waited ``max_wait`` seconds, it is rejected instead, so the
+    work that is admitted keeps a bounded latency under overload.
+    """
+
+    def __init__(self, name, capacity, max_queue, max_wait=MAX_WAIT_SECONDS):
+        self.name = name
+        self.capacity = float(capacity)
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self._in_use = 0.0
+        self._waiters = deque()
+        self._service_seconds = None
+        self._waits = deque(maxlen=1000)
+        self.admitted = 0
+        self.rejected = 0
+
+    @classmethod
+    def from_env(cls, name, capacity, max_queue):
+        """
+        Build a controller whose limits can be overridden with
+        ADMISSION_<NAME>_CAPACITY and ADMISSION_<NAME>_QUEUE.
+        """
+        prefix = f"ADMISSION_{name.upper()}"
+        return cls(
+            name,
+            capacity=float(os.getenv(f"{prefix}_CAPACITY", capacity)),
+            max_queue=int(os.getenv(f"{prefix}_QUEUE", max_queue)),
+        )
+
+    @asynccontextmanager
+    async def admit(self, cost=1):
+        """
+        Hold ``cost`` units for the duration of the block and yield the
+        seconds spent waiting for them. Raises AdmissionRejected if the
+        request cannot be admitted.
+        """
+        cost = min(max(float(cost), 1.0), self.capacity)
+        started = time.monotonic()
+        await self._acquire(cost)
+        waited = time.monotonic() - started
+        self._waits.append(waited)
+        self.admitted += 1
+
+        running = time.monotonic()
+        try:
+            yield waited
+        finally:
+            self._record_service(time.monotonic() - running)
+            self._release(cost)
+
+    def stats(self):
+        """
+        Current load and queue wait percentiles, in milliseconds.
+        """
+        waits = sorted(self._waits)
+
+        def percentile(p):
+            if not waits:
+                return 0.0
+            return round(waits[min(len(waits) - 1, int(p * len(waits)))] * 1000, 1)
+
+        return {
+            "capacity": self.capacity,
+            "in_use": self._in_use,
+            "queued": len(self._waiters),
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "queue_wait_ms": {"p50": percentile(0.5), "p95": percentile(0.95), "p99": percentile(0.99)},
+        }
+
+    async def _acquire(self, cost):
+        if not self._waiters and self._in_use + cost <= self.capacity:
+            self._in_use += cost
+            return
+        if len(self._waiters) >= self.max_queue:
+            self._reject(cost)
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (cost, future)
+        self._waiters.append(entry)
+        try:
+            done, _ = await asyncio.wait({future}, timeout=self.max_wait)
+        except asyncio.CancelledError:
+            # Client went away while queued
+            self._abandon(entry)
+            raise
+        if not done:
+            self._abandon(entry)
+            self._reject(cost)
+
+    def _abandon(self, entry):
+        cost, future = entry
+        if future.done():
+            # The slot was granted just as we gave up on it
+            self._release(cost)
+            return
+        future.cancel()
+        self._waiters.remove(entry)
+        self._wake()
+
+    def _release(self, cost):
+        self._in_use -= cost
+        self._wake()
+
+    def _wake(self):
+        while self._waiters and self._in_use + self._waiters[0][0] <= self.capacity:
+            cost, future = self._waiters.popleft()
+            self._in_use += cost
+            future.set_result(None)
+
+    def _reject(self, cost):
+        self.rejected += 1
+        raise AdmissionRejected(self.name, self._retry_after(cost))
+
+    def _record_service(self, seconds):
+        if self._service_seconds is None:
+            self._service_seconds = seconds
+        else:
+            self._service_seconds = 0.8 * self._service_seconds + 0.2 * seconds
+
+    def _retry_after(self, cost):
+        """
+        Rough time for the current backlog to drain, in whole seconds.
+        """
+        service = self._service_seconds or 1.0
+        backlog = self._in_use + sum(waiting for waiting, _ in self._waiters) + cost
+        return max(1, math.ceil(service * backlog / self.capacity))
@@ -1,5 +1,6 @@
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Security
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Security, Request, Response, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, FileResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel
 from typing import List, Optional, Dict, Any
@@ -7,22 +8,36 @@ import requests
 import os
 from dotenv import load_dotenv
 import openai
-from embedder import get_pdf_text
-from query_handler import format_prompt, ask_llm
-from sentence_transformers import SentenceTransformer
-from vector_store import embed_and_upsert, search
+from embedder import get_pdf_pages
+from query_handler import format_prompt, ask_llm, ask_llm_batch, LLMUnavailable
+from vector_store import embed_and_upsert, search, plan_ingest, embed_document, apply_document
+from local_index import batch_top_k
+from ingest import ingest_documents, spool_upload_to_file, document_lock, document_source
+from admission import AdmissionController, AdmissionRejected
+import profiler
 import json
 import asyncio
+import logging
+import math
 from datetime import datetime
 
 # Load environment variables
 load_dotenv()
+
+logger = logging.getLogger(__name__)
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
 # Webhook configuration
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")
 WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "default_secret")
 
+# How hackrx writes a freshly embedded document to the persistent vector
+# store: "async" (after the response), "sync" (before answering) or "off"
+HACKRX_PERSIST = os.getenv("HACKRX_PERSIST", "async").lower()
+
+# Upload configuration
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_MB", "128")) * 1024 * 1024
+
 # FastAPI setup
 app = FastAPI(
     title="HackRx Document QA API",
@@ -39,11 +54,100 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Admission control: per-endpoint cost budgets with bounded queues. A cost
+# unit is roughly one ordinary request; bigger uploads and longer question
+# lists cost proportionally more.
+ADMISSION_BYTES_PER_UNIT = 10 * 1024 * 1024
+ADMISSION_QUESTIONS_PER_UNIT = 10
+process_admission = AdmissionController.from_env("process", capacity=4, max_queue=16)
+hackrx_admission = AdmissionController.from_env("hackrx", capacity=4, max_queue=16)
+# Ingestion cost is one unit per document
+ingest_admission = AdmissionController.from_env("ingest", capacity=64, max_queue=4)
+# Background hackrx persists run after the request has given its units back,
+# so they get their own small budget; when its queue is full the request
+# persists before answering instead, keeping the backpressure on hackrx
+persist_admission = AdmissionController.from_env("persist", capacity=2, max_queue=16)
+# Retry-After for LLM failures that carry no hint of their own
+LLM_RETRY_AFTER_SECONDS = 30
+
+@app.exception_handler(AdmissionRejected)
+async def admission_rejected_handler(request: Request, exc: AdmissionRejected):
+    return JSONResponse(
+        status_code=429,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
+# The LLM is down or throttling past the scheduler's retries: a temporary
+# failure the client can retry, not a server error
+@app.exception_handler(LLMUnavailable)
+async def llm_unavailable_handler(request: Request, exc: LLMUnavailable):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(math.ceil(exc.retry_after or LLM_RETRY_AFTER_SECONDS))}
+    )
+
+# Reject oversized uploads before the body is spooled
+@app.middleware("http")
+async def limit_upload_size(request: Request, call_next):
+    if request.url.path == "/process/":
+        content_length = request.headers.get("content-length")
+        if content_length and content_length.isdigit() and int(content_length) > MAX_UPLOAD_BYTES:
+            return JSONResponse(
+                status_code=413,
+                content={"detail": f"Upload exceeds {MAX_UPLOAD_BYTES} bytes"}
+            )
+    return await call_next(request)
+
+# On-demand profiling of the expensive endpoints. The middleware is only
+# installed when PROFILE_TOKEN is set, so it costs nothing otherwise.
+PROFILED_PATHS = {"/process/", "/api/v1/hackrx/run"}
+
+async def profile_requests(request: Request, call_next):
+    if request.url.path not in PROFILED_PATHS or not profiler.should_profile(request.headers):
+        return await call_next(request)
+
+    # Profiles the blocking calls this request makes through
+    # profiler.to_thread, not the event loop other requests share
+    request_profile = profiler.start_profile()
+    try:
+        response = await call_next(request)
+    finally:
+        profile_name = profiler.finish_profile(request_profile, request.url.path)
+    if profile_name:
+        response.headers["X-Profile-Id"] = profile_name
+    return response
+
+if profiler.PROFILING_ENABLED:
+    app.middleware("http")(profile_requests)
+
 # Bearer token security
 bearer_scheme = HTTPBearer()
+API_TOKEN = "f5c145545a0ff24b475d29eecc69cccc524203c5e724eb3538d6a4df3e5a5f49"
+
+def verify_token(credentials: HTTPAuthorizationCredentials):
+    if credentials.credentials != API_TOKEN:
+        raise HTTPException(status_code=401, detail="Unauthorized")
 
-# Load embedding model
-model = SentenceTransformer("all-MiniLM-L6-v2")
+# Load embedding model: through the shared embedding server when
+# EMBED_SOCKET is set, otherwise in this worker process
+EMBED_SOCKET = os.getenv("EMBED_SOCKET")
+if EMBED_SOCKET:
+    from embedding_server import EmbeddingClient
+    model = EmbeddingClient(EMBED_SOCKET)
+else:
+    from sentence_transformers import SentenceTransformer
+    model = SentenceTransformer("all-MiniLM-L6-v2")
+
+def upload_size(file: UploadFile) -> int:
+    """
+    Size of an uploaded file without reading it into memory
+    """
+    file.file.seek(0, os.SEEK_END)
+    size = file.file.tell()
+    file.file.seek(0)
+    return size
 
 # Webhook utility functions
 async def send_webhook(event_type: str, data: Dict[str, Any], webhook_url: Optional[str] = None):
@@ -68,7 +172,8 @@ async def send_webhook(event_type: str, data: Dict[str, Any], webhook_url: Optio
     }
     
     try:
-        response = requests.post(
+        response = await asyncio.to_thread(
+            requests.post,
             target_url,
             json=payload,
             headers=headers,
@@ -96,6 +201,47 @@ class WebhookEvent(BaseModel):
 def root():
     return {"message": "PDF Query Bot with OpenAI + Pinecone is running!"}
 
+# ---------------------
+# ✅ Admission Control Status
+# ---------------------
+@app.get("/admission/status")
+async def get_admission_status():
+    """
+    Current load, rejections and queue wait percentiles per endpoint
+    """
+    return {
+        controller.name: controller.stats()
+        for controller in (process_admission, hackrx_admission, ingest_admission, persist_admission)
+    }
+
+# ---------------------
+# ✅ Profile Download (admin)
+# ---------------------
+def verify_profile_token(credentials: HTTPAuthorizationCredentials):
+    if not profiler.PROFILE_TOKEN:
+        raise HTTPException(status_code=404, detail="Profiling is disabled")
+    if credentials.credentials != profiler.PROFILE_TOKEN:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+@app.get("/admin/profiles")
+async def list_profiles(credentials: HTTPAuthorizationCredentials = Security(bearer_scheme)):
+    """
+    List stored request profiles, newest first
+    """
+    verify_profile_token(credentials)
+    return {"profiles": profiler.list_profiles()}
+
+@app.get("/admin/profiles/{name}")
+async def download_profile(name: str, credentials: HTTPAuthorizationCredentials = Security(bearer_scheme)):
+    """
+    Download a stored profile (cProfile/pstats format)
+    """
+    verify_profile_token(credentials)
+    path = profiler.profile_path(name)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return FileResponse(path, media_type="application/octet-stream", filename=name)
+
 # ---------------------
 # ✅ Webhook Configuration Endpoints
 # ---------------------
@@ -147,47 +293,62 @@ async def disable_webhook():
 # ✅ Upload + Query Route with Webhook
 # ---------------------
 @app.post("/process/")
-async def process_file(query: str = Form(...), file: UploadFile = File(...)):
-    try:
-        file_data = await file.read()
-        text = get_pdf_text(file_data)
-
-        # Embed and store vectors
-        embed_and_upsert(text, model)
-
-        # Query handling
-        query_vector = model.encode(query).tolist()
-        relevant_chunks = search(query_vector, top_k=5)
-        prompt = format_prompt(query, relevant_chunks)
-        response = ask_llm(prompt)
-
-        result = {
-            "query": query,
-            "answer": response,
-            "relevant_clauses": relevant_chunks,
-            "file_name": file.filename,
-            "file_size": len(file_data)
-        }
-
-        # Send webhook notification
-        await send_webhook("document_processed", {
-            "file_name": file.filename,
-            "file_size": len(file_data),
-            "query": query,
-            "answer": response
-        })
-
-        return result
-    except Exception as e:
-        error_data = {
-            "error": str(e),
-            "file_name": file.filename if 'file' in locals() else "unknown"
-        }
-        
-        # Send error webhook
-        await send_webhook("error", error_data)
+async def process_file(response: Response, query: str = Form(...), file: UploadFile = File(...)):
+    # Chunked uploads carry no Content-Length, so check the spooled size too
+    file_size = upload_size(file)
+    if file_size > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=f"Upload exceeds {MAX_UPLOAD_BYTES} bytes")
+
+    cost = 1 + file_size / ADMISSION_BYTES_PER_UNIT
+    async with process_admission.admit(cost) as waited:
+        response.headers["X-Queue-Wait-Ms"] = f"{waited * 1000:.1f}"
+
+        try:
+            # Parsing, embedding and vector-store calls block, so they run
+            # on worker threads and the event loop keeps serving requests.
+            # Parse straight from the spooled temp file instead of copying it
+            pages = await profiler.to_thread(get_pdf_pages, file.file)
+
+            # Embed and store vectors
+            source = file.filename or "upload"
+            async with document_lock(source):
+                await profiler.to_thread(embed_and_upsert, pages, model, source)
+
+            # Query handling
+            query_vector = await profiler.to_thread(model.encode, query, convert_to_numpy=True)
+            relevant_chunks = await profiler.to_thread(search, query_vector, 5)
+            prompt = format_prompt(query, relevant_chunks)
+            answer = await ask_llm(prompt)
+
+            result = {
+                "query": query,
+                "answer": answer,
+                "relevant_clauses": relevant_chunks,
+                "file_name": file.filename,
+                "file_size": file_size
+            }
+
+            # Send webhook notification
+            await send_webhook("document_processed", {
+                "file_name": file.filename,
+                "file_size": file_size,
+                "query": query,
+                "answer": answer
+            })
+
+            return result
+        except Exception as e:
+            error_data = {
+                "error": str(e),
+                "file_name": file.filename if 'file' in locals() else "unknown"
+            }
         
-        return {"error": str(e)}
+            # Send error webhook
+            await send_webhook("error", error_data)
+
+            if isinstance(e, LLMUnavailable):
+                raise
+            return {"error": str(e)}
 
 # ---------------------
 # ✅ HackRx API (PDF URL + Questions) with Webhook
@@ -200,63 +361,171 @@ class HackRxInput(BaseModel):
 class HackRxOutput(BaseModel):
     answers: List[str]
 
+async def store_document(plan, chunk_matrix):
+    """
+    Write a hackrx document to the persistent stores under its document
+    lock, re-diffed against whatever version is stored by then
+    """
+    async with document_lock(plan["source"]):
+        await profiler.to_thread(apply_document, plan, chunk_matrix)
+
+async def persist_document(plan, chunk_matrix):
+    """
+    Background task writing a hackrx document to the persistent stores,
+    limited by persist_admission
+    """
+    try:
+        async with persist_admission.admit():
+            await store_document(plan, chunk_matrix)
+    except AdmissionRejected:
+        # Nothing is lost but work: the next request re-embeds the document
+        logger.warning("Persist backlog full, not storing %s", plan["source"])
+    except Exception:
+        logger.exception("Persist failed for %s", plan["source"])
+
+def persist_backlog_full() -> bool:
+    stats = persist_admission.stats()
+    return stats["queued"] >= stats["max_queue"]
+
 @app.post("/api/v1/hackrx/run", response_model=HackRxOutput)
 async def hackrx_handler(
     payload: HackRxInput,
+    response: Response,
+    background_tasks: BackgroundTasks,
     credentials: HTTPAuthorizationCredentials = Security(bearer_scheme)
 ):
-    expected_token = "f5c145545a0ff24b475d29eecc69cccc524203c5e724eb3538d6a4df3e5a5f49"
-    if credentials.credentials != expected_token:
-        raise HTTPException(status_code=401, detail="Unauthorized")
+    verify_token(credentials)
 
-    try:
-        # Step 1: Download PDF from URL
-        pdf_response = requests.get(payload.documents)
-        if pdf_response.status_code != 200:
-            raise HTTPException(status_code=400, detail="Failed to download PDF")
-
-        text = get_pdf_text(pdf_response.content)
-
-        # Step 2: Embed and store vectors
-        embed_and_upsert(text, model)
-
-        # Step 3: Answer each question
-        answers = []
-        for i, question in enumerate(payload.questions):
-            query_vector = model.encode(question).tolist()
-            relevant_chunks = search(query_vector, top_k=5)
-            prompt = format_prompt(question, relevant_chunks)
-            answer = ask_llm(prompt)
-            answers.append(answer)
-            
-            # Send webhook for each question answered
-            await send_webhook("query_answered", {
-                "question_index": i,
-                "question": question,
-                "answer": answer,
-                "document_url": payload.documents
+    cost = 1 + len(payload.questions) / ADMISSION_QUESTIONS_PER_UNIT
+    async with hackrx_admission.admit(cost) as waited:
+        response.headers["X-Queue-Wait-Ms"] = f"{waited * 1000:.1f}"
+
+        try:
+            # Every blocking step below (download, parsing, embedding,
+            # vector-store calls) runs on a worker thread so the event loop
+            # keeps serving other requests meanwhile.
+            # Step 1: Download PDF from URL
+            pdf_response = await profiler.to_thread(requests.get, payload.documents)
+            if pdf_response.status_code != 200:
+                raise HTTPException(status_code=400, detail="Failed to download PDF")
+
+            pages = await profiler.to_thread(get_pdf_pages, pdf_response.content)
+
+            # Step 2: Embed the document, reusing stored vectors for unchanged
+            # chunks, and keep its matrix in memory for this request
+            plan = await profiler.to_thread(plan_ingest, pages, document_source(payload.documents))
+            chunk_matrix, _ = await profiler.to_thread(embed_document, plan, model)
+            if HACKRX_PERSIST == "sync":
+                await store_document(plan, chunk_matrix)
+
+            # Step 3: The questions only concern this document, so retrieve
+            # every question's top chunks with one matrix product instead of
+            # a vector-store round trip per question. Then answer the
+            # questions concurrently: the LLM scheduler keeps the combined
+            # load within the rate limits, and prioritising by question index
+            # lets every request's first answers through before the tails of
+            # long batches.
+            query_vectors = await profiler.to_thread(model.encode, payload.questions, convert_to_numpy=True)
+            top_rows = await profiler.to_thread(batch_top_k, query_vectors, chunk_matrix, 5)
+            prompts = [
+                format_prompt(question, [plan["chunks"][row]["text"] for row in top_rows[i]])
+                for i, question in enumerate(payload.questions)
+            ]
+            answers = await ask_llm_batch(prompts)
+
+            for i, (question, answer) in enumerate(zip(payload.questions, answers)):
+                # Send webhook for each question answered
+                await send_webhook("query_answered", {
+                    "question_index": i,
+                    "question": question,
+                    "answer": answer,
+                    "document_url": payload.documents
+                }, payload.webhook_url)
+
+            # Send completion webhook
+            await send_webhook("document_processed", {
+                "document_url": payload.documents,
+                "questions_count": len(payload.questions),
+                "answers": answers
             }, payload.webhook_url)
 
-        # Send completion webhook
-        await send_webhook("document_processed", {
-            "document_url": payload.documents,
-            "questions_count": len(payload.questions),
-            "answers": answers
-        }, payload.webhook_url)
+            if HACKRX_PERSIST == "async":
+                if persist_backlog_full():
+                    await store_document(plan, chunk_matrix)
+                else:
+                    background_tasks.add_task(persist_document, plan, chunk_matrix)
 
-        return {"answers": answers}
+            return {"answers": answers}
 
-    except Exception as e:
-        error_data = {
-            "error": str(e),
-            "document_url": payload.documents,
-            "questions": payload.questions
-        }
-        
-        # Send error webhook
-        await send_webhook("error", error_data, payload.webhook_url)
+        except Exception as e:
+            error_data = {
+                "error": str(e),
+                "document_url": payload.documents,
+                "questions": payload.questions
+            }
         
-        raise HTTPException(status_code=500, detail=str(e))
+            # Send error webhook
+            await send_webhook("error", error_data, payload.webhook_url)
+
+            if isinstance(e, LLMUnavailable):
+                raise
+            raise HTTPException(status_code=500, detail=str(e))
+
+# ---------------------
+# ✅ Bulk Ingestion (many documents, no questions) with Webhook
+# ---------------------
+class IngestInput(BaseModel):
+    documents: List[str]
+    webhook_url: Optional[str] = None
+
+async def run_bulk_ingest(items, webhook_url: Optional[str] = None):
+    report = await ingest_documents(items, model, MAX_UPLOAD_BYTES)
+
+    await send_webhook("documents_ingested", {
+        key: value for key, value in report.items() if key != "documents"
+    }, webhook_url)
+    failed = [doc for doc in report["documents"] if doc["status"] == "failed"]
+    if failed:
+        await send_webhook("error", {"error": "Bulk ingestion failed for some documents", "documents": failed}, webhook_url)
+
+    return report
+
+@app.post("/api/v1/ingest")
+async def ingest_handler(
+    payload: IngestInput,
+    response: Response,
+    credentials: HTTPAuthorizationCredentials = Security(bearer_scheme)
+):
+    """
+    Index a list of PDF URLs without asking any questions
+    """
+    verify_token(credentials)
+    items = [{"source": document_source(url), "url": url} for url in payload.documents]
+    async with ingest_admission.admit(len(items)) as waited:
+        response.headers["X-Queue-Wait-Ms"] = f"{waited * 1000:.1f}"
+        return await run_bulk_ingest(items, payload.webhook_url)
+
+@app.post("/api/v1/ingest/upload")
+async def ingest_upload_handler(
+    response: Response,
+    files: List[UploadFile] = File(...),
+    credentials: HTTPAuthorizationCredentials = Security(bearer_scheme)
+):
+    """
+    Index uploaded PDFs without asking any questions
+    """
+    verify_token(credentials)
+    for file in files:
+        if upload_size(file) > MAX_UPLOAD_BYTES:
+            raise HTTPException(status_code=413, detail=f"{file.filename} exceeds {MAX_UPLOAD_BYTES} bytes")
+
+    async with ingest_admission.admit(len(files)) as waited:
+        response.headers["X-Queue-Wait-Ms"] = f"{waited * 1000:.1f}"
+        items = []
+        for file in files:
+            path = await asyncio.to_thread(spool_upload_to_file, file.file)
+            items.append({"source": file.filename or "upload", "path": path})
+        return await run_bulk_ingest(items)
 
 # ---------------------
 # ✅ Manual Webhook Trigger
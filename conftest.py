@@ -0,0 +1,16 @@
+"""
+Point the document store and vector index at a throwaway directory before
+any test imports them, so tests never touch Pinecone or real data.
+"""
+
+import atexit
+import os
+import shutil
+import tempfile
+
+_store = tempfile.mkdtemp(prefix="llm_doc_test_")
+atexit.register(shutil.rmtree, _store, ignore_errors=True)
+
+os.environ["VECTOR_BACKEND"] = "local"
+os.environ["LOCAL_INDEX_DIR"] = os.path.join(_store, "vector_index")
+os.environ["DOC_DB_PATH"] = os.path.join(_store, "documents.db")
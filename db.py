@@ -0,0 +1,143 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# SQLite file holding documents and chunk text; vectors only carry chunk ids
+DB_PATH = os.getenv("DOC_DB_PATH", "documents.db")
+
+# SQLite caps the number of bound parameters per statement
+MAX_QUERY_PARAMS = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    id TEXT PRIMARY KEY,
+    source TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    page_count INTEGER NOT NULL,
+    chunk_count INTEGER NOT NULL,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS chunks (
+    id TEXT PRIMARY KEY,
+    document_id TEXT NOT NULL REFERENCES documents(id) ON DELETE CASCADE,
+    ordinal INTEGER NOT NULL,
+    page INTEGER NOT NULL,
+    start_offset INTEGER NOT NULL,
+    end_offset INTEGER NOT NULL,
+    content_hash TEXT NOT NULL,
+    text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS chunks_document ON chunks(document_id, ordinal);
+"""
+
+_local = threading.local()
+
+def get_connection():
+    """
+    Return this thread's SQLite connection, creating the schema on first use.
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, timeout=30)
+        conn.row_factory = sqlite3.Row
+        # WAL lets every uvicorn worker read while one of them writes
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+        conn.executescript(SCHEMA)
+        _local.conn = conn
+    return conn
+
+def hash_text(text):
+    """
+    SHA-256 hex digest of a string.
+    """
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def document_id_for(source):
+    """
+    Stable document id derived from where the document came from.
+    """
+    return hashlib.sha1(source.encode("utf-8")).hexdigest()[:16]
+
+def get_document(document_id):
+    """
+    Fetch a document row as a dict, or None if it was never ingested.
+    """
+    row = get_connection().execute(
+        "SELECT * FROM documents WHERE id = ?", (document_id,)
+    ).fetchone()
+    return dict(row) if row else None
+
+def get_chunk_ids(document_id):
+    """
+    Ids of a document's stored chunks in reading order.
+    """
+    rows = get_connection().execute(
+        "SELECT id FROM chunks WHERE document_id = ? ORDER BY ordinal", (document_id,)
+    ).fetchall()
+    return [row["id"] for row in rows]
+
+def save_document(document_id, source, content_hash, page_count, chunks):
+    """
+    Insert or replace a document and all of its chunks in one transaction.
+
+    Each chunk is a dict with id, page, start, end, hash and text keys.
+    """
+    now = datetime.utcnow().isoformat()
+    conn = get_connection()
+    with conn:
+        conn.execute(
+            """
+            INSERT INTO documents (id, source, content_hash, page_count, chunk_count, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(id) DO UPDATE SET
+                source = excluded.source,
+                content_hash = excluded.content_hash,
+                page_count = excluded.page_count,
+                chunk_count = excluded.chunk_count,
+                updated_at = excluded.updated_at
+            """,
+            (document_id, source, content_hash, page_count, len(chunks), now, now)
+        )
+        conn.execute("DELETE FROM chunks WHERE document_id = ?", (document_id,))
+        conn.executemany(
+            """
+            INSERT INTO chunks (id, document_id, ordinal, page, start_offset, end_offset, content_hash, text)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            [
+                (chunk["id"], document_id, ordinal, chunk["page"], chunk["start"], chunk["end"], chunk["hash"], chunk["text"])
+                for ordinal, chunk in enumerate(chunks)
+            ]
+        )
+
+def delete_document(document_id):
+    """
+    Remove a document and its chunks.
+    """
+    conn = get_connection()
+    with conn:
+        conn.execute("DELETE FROM documents WHERE id = ?", (document_id,))
+
+def get_chunk_texts(chunk_ids):
+    """
+    Look up chunk text for a list of ids in one batched query, preserving
+    the order of ``chunk_ids``. Ids with no stored chunk are skipped.
+    """
+    texts = {}
+    conn = get_connection()
+    for i in range(0, len(chunk_ids), MAX_QUERY_PARAMS):
+        batch = chunk_ids[i:i + MAX_QUERY_PARAMS]
+        placeholders = ",".join("?" * len(batch))
+        rows = conn.execute(
+            f"SELECT id, text FROM chunks WHERE id IN ({placeholders})", batch
+        ).fetchall()
+        texts.update((row["id"], row["text"]) for row in rows)
+    return [texts[chunk_id] for chunk_id in chunk_ids if chunk_id in texts]
@@ -1,14 +1,63 @@
 from PyPDF2 import PdfReader
+from contextlib import contextmanager
 import io
+import mmap
+import os
 
-def get_pdf_text(file_bytes):
+@contextmanager
+def open_pdf_stream(source):
+    """
+    Yield a seekable binary stream over a PDF without copying it.
+
+    ``source`` may be raw bytes, a file path, or a binary file object such as
+    an upload's spooled temp file. Files backed by a real descriptor are
+    memory-mapped; in-memory sources are read in place.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        yield io.BytesIO(source)
+        return
+
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, "rb") as f:
+            with _mmap_or_file(f) as stream:
+                yield stream
+        return
+
+    # A SpooledTemporaryFile that has not rolled over to disk would be
+    # forced onto disk by fileno(), so read it where it is.
+    if getattr(source, "_rolled", True):
+        with _mmap_or_file(source) as stream:
+            yield stream
+        return
+
+    source.seek(0)
+    yield source
+
+@contextmanager
+def _mmap_or_file(f):
+    try:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, io.UnsupportedOperation, OSError, ValueError):
+        # No descriptor, or an empty file (which cannot be mapped)
+        f.seek(0)
+        yield f
+        return
+    try:
+        yield mapped
+    finally:
+        mapped.close()
+
+def get_pdf_pages(source):
+    """
+    Extract the text of every page of a PDF. Pages without text are
+    returned as empty strings so list positions match page numbers.
+    """
+    with open_pdf_stream(source) as stream:
+        reader = PdfReader(stream)
+        return [page.extract_text() or "" for page in reader.pages]
+
+def get_pdf_text(source):
     """
     Extract text from a PDF (all pages).
     """
-    reader = PdfReader(io.BytesIO(file_bytes))
-    text = ""
-    for page in reader.pages:
-        content = page.extract_text()
-        if content:
-            text += content + "\n"
-    return text
+    return "".join(page + "\n" for page in get_pdf_pages(source) if page)
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""
+Shared embedding server.
+
+Runs the sentence-transformer in a small pool of worker processes with a
+fixed thread budget and serves every uvicorn worker over a Unix socket.
+Result matrices are written straight into shared memory created by the
+client, so only a short JSON header crosses the socket.
+
+    python embedding_server.py
+    EMBED_SOCKET=/tmp/llm_doc_embed.sock uvicorn app:app --workers 4
+"""
+
+import json
+import multiprocessing
+import os
+import socket
+import socketserver
+import struct
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import resource_tracker, shared_memory
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+EMBED_SOCKET = os.getenv("EMBED_SOCKET", "/tmp/llm_doc_embed.sock")
+EMBED_MODEL_NAME = os.getenv("EMBED_MODEL_NAME", "all-MiniLM-L6-v2")
+EMBED_PROCESSES = int(os.getenv("EMBED_PROCESSES", "1"))
+# Total inference threads across all processes; the remaining cores are
+# left to the uvicorn workers
+EMBED_THREADS = int(os.getenv("EMBED_THREADS", str(max(1, (os.cpu_count() or 2) // 2))))
+# Longest a client waits for one reply before giving up on the server
+EMBED_TIMEOUT_SECONDS = float(os.getenv("EMBED_TIMEOUT_SECONDS", "120"))
+
+HEADER = struct.Struct("!I")
+
+# ---------------------
+# Framing
+# ---------------------
+def send_message(sock, message):
+    data = json.dumps(message).encode("utf-8")
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+def recv_message(sock):
+    header = _recv_exact(sock, HEADER.size)
+    if header is None:
+        return None
+    data = _recv_exact(sock, HEADER.unpack(header)[0])
+    if data is None:
+        raise ConnectionError("Connection closed mid-message")
+    return json.loads(data)
+
+def _recv_exact(sock, size):
+    buffer = bytearray()
+    while len(buffer) < size:
+        block = sock.recv(size - len(buffer))
+        if not block:
+            return None
+        buffer.extend(block)
+    return bytes(buffer)
+
+def _attach(name):
+    """
+    Attach to a client's shared memory block without letting this process's
+    resource tracker unlink it on exit; the client owns its lifetime.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 has no track argument
+        block = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(block._name, "shared_memory")
+        return block
+
+# ---------------------
+# Worker processes
+# ---------------------
+_model = None
+
+def _init_worker(threads):
+    global _model
+    # Set before torch is imported so its thread pools honour the budget
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    os.environ["MKL_NUM_THREADS"] = str(threads)
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    torch.set_num_threads(threads)
+    _model = SentenceTransformer(EMBED_MODEL_NAME)
+
+def _dimension():
+    return _model.get_sentence_embedding_dimension()
+
+def _encode_into(texts, shm_name, batch_size, normalize_embeddings):
+    embeddings = _model.encode(
+        texts,
+        batch_size=batch_size,
+        convert_to_numpy=True,
+        normalize_embeddings=normalize_embeddings
+    )
+    block = _attach(shm_name)
+    try:
+        out = np.ndarray(embeddings.shape, dtype=np.float32, buffer=block.buf)
+        out[:] = embeddings
+        del out
+    finally:
+        block.close()
+    return embeddings.shape
+
+# ---------------------
+# Server
+# ---------------------
+class WorkerPool:
+    """
+    The model worker processes, rebuilt if one of them dies. A dead worker
+    (e.g. OOM-killed) breaks a ProcessPoolExecutor for good, which would
+    otherwise fail every later request.
+    """
+
+    def __init__(self, processes, threads):
+        self.processes = processes
+        self.threads = threads
+        self._lock = threading.Lock()
+        self._pool = self._start()
+        # Load the model before accepting connections
+        self.dimension = self._pool.submit(_dimension).result()
+
+    def _start(self):
+        return ProcessPoolExecutor(
+            max_workers=self.processes,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(max(1, self.threads // self.processes),)
+        )
+
+    def run(self, fn, *args):
+        """
+        Run ``fn`` in a worker, retrying once on a fresh pool if the pool
+        breaks under it.
+        """
+        for attempt in range(2):
+            pool = self._pool
+            try:
+                return pool.submit(fn, *args).result()
+            except BrokenProcessPool:
+                with self._lock:
+                    if self._pool is pool:
+                        print("Embedding worker died, restarting the pool")
+                        pool.shutdown(wait=False, cancel_futures=True)
+                        self._pool = self._start()
+                if attempt == 1:
+                    raise
+
+    def shutdown(self):
+        self._pool.shutdown()
+
+def serve(socket_path=EMBED_SOCKET, processes=EMBED_PROCESSES, threads=EMBED_THREADS):
+    """
+    Start the worker pool and serve encode requests until interrupted.
+    """
+    pool = WorkerPool(processes, threads)
+    dimension = pool.dimension
+
+    class Handler(socketserver.BaseRequestHandler):
+        def handle(self):
+            while True:
+                request = recv_message(self.request)
+                if request is None:
+                    return
+                if request.get("op") == "info":
+                    send_message(self.request, {"ok": True, "dim": dimension, "model": EMBED_MODEL_NAME})
+                    continue
+                try:
+                    shape = pool.run(
+                        _encode_into,
+                        request["texts"],
+                        request["shm"],
+                        request.get("batch_size", 32),
+                        request.get("normalize_embeddings", False)
+                    )
+                    send_message(self.request, {"ok": True, "shape": list(shape)})
+                except Exception as e:
+                    send_message(self.request, {"ok": False, "error": str(e)})
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    with socketserver.ThreadingUnixStreamServer(socket_path, Handler) as server:
+        server.daemon_threads = True
+        print(f"Embedding server: {EMBED_MODEL_NAME} on {socket_path} "
+              f"({processes} processes, {threads} threads)")
+        try:
+            server.serve_forever()
+        finally:
+            pool.shutdown()
+            os.remove(socket_path)
+
+# ---------------------
+# Client
+# ---------------------
+class EmbeddingClient:
+    """
+    Drop-in replacement for ``SentenceTransformer.encode`` that delegates
+    to the embedding server. Each thread keeps its own connection.
+    """
+
+    def __init__(self, socket_path=EMBED_SOCKET, timeout=EMBED_TIMEOUT_SECONDS):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._local = threading.local()
+        self.dimension = self._call({"op": "info"})["dim"]
+
+    def encode(self, sentences, batch_size=32, convert_to_numpy=True, normalize_embeddings=False, **kwargs):
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        if not texts:
+            return np.empty((0, self.dimension), dtype=np.float32)
+
+        block = shared_memory.SharedMemory(create=True, size=len(texts) * self.dimension * 4)
+        try:
+            self._call({
+                "texts": texts,
+                "shm": block.name,
+                "batch_size": batch_size,
+                "normalize_embeddings": normalize_embeddings
+            })
+            view = np.ndarray((len(texts), self.dimension), dtype=np.float32, buffer=block.buf)
+            # One memcpy out of shared memory so the block can be freed now
+            embeddings = view.copy()
+            del view
+        finally:
+            block.close()
+            block.unlink()
+        return embeddings[0] if single else embeddings
+
+    def _call(self, message):
+        for attempt in range(2):
+            conn = getattr(self._local, "conn", None)
+            try:
+                if conn is None:
+                    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                    # A hung server must not block the calling thread forever
+                    conn.settimeout(self.timeout)
+                    conn.connect(self.socket_path)
+                    self._local.conn = conn
+                send_message(conn, message)
+                response = recv_message(conn)
+                if response is None:
+                    raise ConnectionError("Embedding server closed the connection")
+                break
+            except TimeoutError:
+                # The reply may still arrive later, so this connection is
+                # out of step; drop it, and do not resend the same work
+                self._local.conn = None
+                conn.close()
+                raise
+            except OSError:
+                # Reconnect once, e.g. after the server restarted
+                self._local.conn = None
+                if conn is not None:
+                    conn.close()
+                if attempt == 1:
+                    raise
+        if not response.get("ok"):
+            raise RuntimeError(f"Embedding server error: {response.get('error')}")
+        return response
+
+if __name__ == "__main__":
+    serve()
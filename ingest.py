@@ -0,0 +1,244 @@
+import asyncio
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import weakref
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+import requests
+from dotenv import load_dotenv
+import db
+from embedder import get_pdf_pages
+from vector_store import plan_ingest, embed_plan, apply_plan
+
+load_dotenv()
+
+# Bounded worker pools, one per pipeline stage
+DOWNLOAD_WORKERS = int(os.getenv("INGEST_DOWNLOAD_WORKERS", "8"))
+PARSE_WORKERS = int(os.getenv("INGEST_PARSE_WORKERS", str(os.cpu_count() or 2)))
+# The embedding model already uses every core; more workers only contend
+EMBED_WORKERS = int(os.getenv("INGEST_EMBED_WORKERS", "1"))
+UPSERT_WORKERS = int(os.getenv("INGEST_UPSERT_WORKERS", "4"))
+# Documents held between stages at once (each one is a temp file on disk)
+MAX_IN_FLIGHT = int(os.getenv("INGEST_MAX_IN_FLIGHT", "32"))
+
+DOWNLOAD_TIMEOUT = 60
+DOWNLOAD_CHUNK_BYTES = 1024 * 1024
+
+# Signed-URL schemes whose parameters change on every link to the same file.
+# Each set is only stripped when its marker parameter is present, since
+# names like "policy" or "st" are ordinary parameters elsewhere.
+SIGNATURE_SCHEMES = [
+    # Azure SAS
+    ("sig", {"sig", "se", "st", "sp", "sv", "sr", "spr", "srt", "ss", "sdd", "si",
+             "skoid", "sktid", "skt", "ske", "sks", "skv"}),
+    # CloudFront signed URLs
+    ("key-pair-id", {"key-pair-id", "policy", "signature", "expires"}),
+    # Google Cloud Storage V2 signed URLs
+    ("googleaccessid", {"googleaccessid", "signature", "expires"}),
+]
+# AWS SigV4 and Google V4 parameters are unambiguous by their prefix
+SIGNATURE_PREFIXES = ("x-amz-", "x-goog-")
+
+_pools = {}
+# One asyncio.Lock per document being written, dropped once unused
+_document_locks = weakref.WeakValueDictionary()
+
+def _parse_pool(workers):
+    # PyPDF2 is pure Python, so parsing only scales across processes.
+    # spawn keeps the children free of the parent's model and threads.
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+def _pool(stage):
+    """
+    Create each stage's executor on first use and keep it for the process.
+    """
+    if stage not in _pools:
+        if stage == "parse":
+            _pools[stage] = _parse_pool(PARSE_WORKERS)
+        else:
+            workers = {"download": DOWNLOAD_WORKERS, "embed": EMBED_WORKERS, "upsert": UPSERT_WORKERS}[stage]
+            _pools[stage] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"ingest-{stage}")
+    return _pools[stage]
+
+def document_source(url):
+    """
+    Identify a downloaded document by its URL without signature and expiry
+    parameters, so signed links to the same file map to the same stored
+    document while other parameters (e.g. a policy number) still tell files
+    apart.
+    """
+    parts = urlsplit(url)
+    query = parse_qsl(parts.query, keep_blank_values=True)
+    keys = {key.lower() for key, _ in query}
+    stripped = set()
+    for marker, params in SIGNATURE_SCHEMES:
+        if marker in keys:
+            stripped |= params
+    query = [
+        (key, value) for key, value in query
+        if key.lower() not in stripped and not key.lower().startswith(SIGNATURE_PREFIXES)
+    ]
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(sorted(query)), ""))
+
+def document_lock(source):
+    """
+    Lock serialising plan -> apply for one document within this process,
+    so two versions of a document are never diffed against the same
+    stored state at once.
+    """
+    document_id = db.document_id_for(source)
+    lock = _document_locks.get(document_id)
+    if lock is None:
+        lock = _document_locks[document_id] = asyncio.Lock()
+    return lock
+
+def _discard_pool(stage, pool):
+    """
+    Drop a broken executor so the next ``_pool`` call builds a fresh one.
+    """
+    if _pools.get(stage) is pool:
+        del _pools[stage]
+    pool.shutdown(wait=False, cancel_futures=True)
+
+async def _parse(path, isolated):
+    """
+    Parse a document in the shared parse pool.
+
+    A parse child that dies (e.g. OOM-killed on a pathological PDF) breaks
+    the whole pool and fails every document queued on it. The pool is then
+    replaced, and each of those documents is retried once in a pool of its
+    own, so only the one that kills its own child is reported as failed.
+    """
+    loop = asyncio.get_running_loop()
+    pool = _pool("parse")
+    try:
+        return await loop.run_in_executor(pool, get_pdf_pages, path)
+    except BrokenProcessPool:
+        _discard_pool("parse", pool)
+
+    async with isolated:
+        pool = _parse_pool(1)
+        try:
+            return await loop.run_in_executor(pool, get_pdf_pages, path)
+        except BrokenProcessPool:
+            raise RuntimeError("The parser process died on this document (out of memory?)") from None
+        finally:
+            pool.shutdown(wait=False)
+
+def download_to_file(url, max_bytes):
+    """
+    Stream a document to a temp file on disk and return its path.
+    """
+    with requests.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+        if response.status_code != 200:
+            raise ValueError(f"Failed to download document: HTTP {response.status_code}")
+        with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as f:
+            try:
+                size = 0
+                for block in response.iter_content(DOWNLOAD_CHUNK_BYTES):
+                    size += len(block)
+                    if size > max_bytes:
+                        raise ValueError(f"Document exceeds {max_bytes} bytes")
+                    f.write(block)
+            except Exception:
+                f.close()
+                os.remove(f.name)
+                raise
+            return f.name
+
+def spool_upload_to_file(upload_file):
+    """
+    Copy an upload's spooled file to a named temp file the parse workers
+    can open, streaming rather than reading it into memory.
+    """
+    upload_file.seek(0)
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as f:
+        shutil.copyfileobj(upload_file, f, DOWNLOAD_CHUNK_BYTES)
+        return f.name
+
+async def _ingest_one(item, embed_model, max_bytes, in_flight, isolated):
+    """
+    Run one document through download, parse, plan, embed and upsert.
+    """
+    loop = asyncio.get_running_loop()
+    result = {"source": item["source"], "status": "failed"}
+    started = time.perf_counter()
+    path = item.get("path")
+
+    async with in_flight:
+        try:
+            if path is None:
+                path = await loop.run_in_executor(_pool("download"), download_to_file, item["url"], max_bytes)
+            pages = await _parse(path, isolated)
+            async with document_lock(item["source"]):
+                plan = await loop.run_in_executor(_pool("upsert"), plan_ingest, pages, item["source"])
+                if not plan["unchanged"]:
+                    embeddings = await loop.run_in_executor(_pool("embed"), embed_plan, plan, embed_model)
+                    await loop.run_in_executor(_pool("upsert"), apply_plan, plan, embeddings)
+
+            result.update({
+                "status": "unchanged" if plan["unchanged"] else "indexed",
+                "document_id": plan["document_id"],
+                "pages": plan["page_count"],
+                "chunks": len(plan["chunks"]),
+                "embedded": len(plan["new_chunks"]),
+                "deleted": len(plan["removed_ids"])
+            })
+        except Exception as e:
+            result["error"] = str(e)
+        finally:
+            if path is not None:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    result["seconds"] = round(time.perf_counter() - started, 3)
+    return result
+
+async def _skip_duplicate(item):
+    if item.get("path") is not None:
+        try:
+            os.remove(item["path"])
+        except OSError:
+            pass
+    return {"source": item["source"], "status": "duplicate", "seconds": 0.0}
+
+async def ingest_documents(items, embed_model, max_bytes):
+    """
+    Ingest many documents in parallel and report per-document status.
+
+    Each item is a dict with a ``source`` and either a ``url`` to download
+    or a ``path`` to an already spooled file (which is removed afterwards).
+    Every stage runs in its own bounded pool, so downloads, parsing and
+    embedding of different documents overlap. When several items share a
+    source only the last one is ingested; the others are reported as
+    ``duplicate``.
+    """
+    last = {item["source"]: i for i, item in enumerate(items)}
+    in_flight = asyncio.Semaphore(MAX_IN_FLIGHT)
+    # Bounds the single-document parse pools used after a crash
+    isolated = asyncio.Semaphore(PARSE_WORKERS)
+    started = time.perf_counter()
+    results = await asyncio.gather(*(
+        _ingest_one(item, embed_model, max_bytes, in_flight, isolated) if last[item["source"]] == i
+        else _skip_duplicate(item)
+        for i, item in enumerate(items)
+    ))
+    elapsed = time.perf_counter() - started
+
+    counts = {"indexed": 0, "unchanged": 0, "duplicate": 0, "failed": 0}
+    for result in results:
+        counts[result["status"]] += 1
+
+    return {
+        "documents": results,
+        "total": len(results),
+        **counts,
+        "elapsed_seconds": round(elapsed, 3),
+        "docs_per_second": round(len(results) / elapsed, 3) if elapsed > 0 else None
+    }
@@ -0,0 +1,256 @@
+import asyncio
+import heapq
+import itertools
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Error classes worth retrying across openai client versions
+RETRYABLE_ERRORS = {
+    "RateLimitError",
+    "ServiceUnavailableError",
+    "APIConnectionError",
+    "APITimeoutError",
+    "InternalServerError",
+    "Timeout",
+    "TryAgain",
+}
+
+class TokenBucket:
+    """
+    Budget of ``per_minute`` units that refills continuously.
+    """
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """
+        Seconds until ``amount`` units are available (0 if they are now).
+        """
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount):
+        self._refill()
+        self.tokens -= amount
+
+    def adjust(self, amount):
+        """
+        Give back (positive) or charge (negative) units after the fact.
+        """
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+    def drain(self):
+        self._refill()
+        self.tokens = min(self.tokens, 0.0)
+
+class LLMScheduler:
+    """
+    Process-wide gate in front of the OpenAI API.
+
+    Calls wait on the event loop in a priority queue (lower number first,
+    FIFO within a priority) until a concurrency slot, a request token and
+    enough prompt + completion tokens are available. Only the admitted
+    HTTP call runs on a thread, in a pool sized to the concurrency limit,
+    so waiting calls never hold a thread and a shared executor's FIFO
+    cannot reorder them. Throttled and 5xx responses
+    are retried with jittered exponential backoff. Concurrency is halved
+    when the API throttles and grows back by one slot after a full window
+    of successful calls.
+    """
+
+    def __init__(self, requests_per_minute, tokens_per_minute, max_concurrency,
+                 min_concurrency=1, max_retries=5, base_delay=1.0, max_delay=30.0,
+                 throttle_cooldown=5.0):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.throttle_cooldown = throttle_cooldown
+
+        self._cond = asyncio.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="llm")
+        self._queue = []
+        self._sequence = itertools.count()
+        self._in_flight = 0
+        self._successes = 0
+        self._last_throttle = 0.0
+        self.stats = {"calls": 0, "retries": 0, "throttled": 0, "failed": 0}
+
+    async def submit(self, call, estimated_tokens, priority=0):
+        """
+        Run the blocking ``call()`` under the scheduler and return its result.
+
+        ``estimated_tokens`` is charged up front; if the result exposes
+        ``usage.total_tokens`` the bucket is corrected afterwards.
+        """
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.max_retries + 1):
+            await self._acquire(estimated_tokens, priority)
+            try:
+                result = await loop.run_in_executor(self._executor, call)
+            except Exception as e:
+                await self._release()
+                status = error_status(e)
+                throttled = status == 429 or type(e).__name__ == "RateLimitError"
+                if throttled:
+                    await self._on_throttle()
+                retryable = throttled or (status is not None and status >= 500) \
+                    or type(e).__name__ in RETRYABLE_ERRORS
+                if not retryable or attempt == self.max_retries:
+                    self.stats["failed"] += 1
+                    raise
+                self.stats["retries"] += 1
+                await asyncio.sleep(self._backoff(attempt, retry_after(e)))
+                continue
+            except BaseException:
+                # Cancelled while the call runs; the thread finishes on its own
+                await self._release()
+                raise
+
+            await self._release(success=True)
+            actual = _total_tokens(result)
+            if actual is not None:
+                async with self._cond:
+                    self.tokens.adjust(estimated_tokens - actual)
+                    self._cond.notify_all()
+            return result
+
+    def snapshot(self):
+        """
+        Current scheduler state, for diagnostics.
+        """
+        return {
+            "concurrency": self.concurrency,
+            "in_flight": self._in_flight,
+            "queued": len(self._queue),
+            **self.stats,
+        }
+
+    async def _acquire(self, estimated_tokens, priority):
+        ticket = (priority, next(self._sequence))
+        async with self._cond:
+            heapq.heappush(self._queue, ticket)
+            try:
+                while True:
+                    timeout = None
+                    if self._queue[0] == ticket and self._in_flight < self.concurrency:
+                        timeout = max(self.requests.wait_time(1), self.tokens.wait_time(estimated_tokens))
+                        if timeout == 0:
+                            heapq.heappop(self._queue)
+                            self.requests.take(1)
+                            self.tokens.take(estimated_tokens)
+                            self._in_flight += 1
+                            self.stats["calls"] += 1
+                            # The next ticket may be admissible right away
+                            self._cond.notify_all()
+                            return
+                    try:
+                        await asyncio.wait_for(self._cond.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+            except asyncio.CancelledError:
+                # Caller went away while queued; let the next ticket move up
+                if ticket in self._queue:
+                    self._queue.remove(ticket)
+                    heapq.heapify(self._queue)
+                    self._cond.notify_all()
+                raise
+
+    async def _release(self, success=False):
+        async with self._cond:
+            self._in_flight -= 1
+            if success:
+                self._successes += 1
+                if self._successes >= self.concurrency and self.concurrency < self.max_concurrency:
+                    self.concurrency += 1
+                    self._successes = 0
+            self._cond.notify_all()
+
+    async def _on_throttle(self):
+        async with self._cond:
+            self.stats["throttled"] += 1
+            self._successes = 0
+            # Pause new calls until the buckets refill
+            self.requests.drain()
+            self.tokens.drain()
+            now = time.monotonic()
+            # One burst of 429s should only shrink the window once
+            if now - self._last_throttle >= self.throttle_cooldown:
+                self.concurrency = max(self.min_concurrency, self.concurrency // 2)
+                self._last_throttle = now
+
+    def _backoff(self, attempt, hint=None):
+        delay = min(self.max_delay, self.base_delay * (2 ** attempt))
+        delay = random.uniform(delay / 2, delay)
+        if hint:
+            delay = max(delay, min(hint, self.max_delay))
+        return delay
+
+def error_status(exc):
+    """
+    HTTP status carried by an API exception, if any.
+    """
+    for attr in ("http_status", "status_code"):
+        status = getattr(exc, attr, None)
+        if isinstance(status, int):
+            return status
+    return None
+
+def retry_after(exc):
+    """
+    Seconds suggested by a Retry-After header on an API exception, if any.
+    """
+    headers = getattr(exc, "headers", None)
+    if headers is None:
+        response = getattr(exc, "response", None)
+        headers = getattr(response, "headers", None)
+    try:
+        return float(headers.get("retry-after"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+def _total_tokens(result):
+    usage = getattr(result, "usage", None)
+    if usage is None and isinstance(result, dict):
+        usage = result.get("usage")
+    if usage is None:
+        return None
+    if isinstance(usage, dict):
+        return usage.get("total_tokens")
+    return getattr(usage, "total_tokens", None)
+
+def estimate_tokens(text, max_tokens=0):
+    """
+    Rough prompt size (about four characters per token) plus the
+    completion budget.
+    """
+    return len(text) // 4 + max_tokens
+
+scheduler = LLMScheduler(
+    requests_per_minute=int(os.getenv("LLM_RPM_LIMIT", "500")),
+    tokens_per_minute=int(os.getenv("LLM_TPM_LIMIT", "200000")),
+    max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", "8")),
+    max_retries=int(os.getenv("LLM_MAX_RETRIES", "5")),
+)
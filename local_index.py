@@ -0,0 +1,447 @@
+import fcntl
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+
+class LocalVectorIndex:
+    """
+    Persistent cosine-similarity index stored in memory-mapped files.
+
+    Every uvicorn worker opens the same directory read-only, so the vector
+    pages live once in the OS page cache no matter how many workers run.
+    Writes go to an append segment; once it grows large enough it is
+    compacted into a new base segment. Directory layout:
+
+        manifest.json        generation, dimension, dtype, id width, base rows
+        base-<gen>.npy       compacted vectors (L2-normalised), sorted by id
+        base-<gen>.ids.npy   fixed-width ids of the base rows, sorted
+        append-<gen>.f32     rows written since the last compaction
+        append-<gen>.ids     one fixed-size (deleted flag, id) record per row
+        lock                 flock target shared by all processes
+
+    Ids are stored as fixed-width bytes (``id_bytes``, 64 by default), so
+    both id files are memory-mapped like the vectors. Base ids are looked up
+    with a binary search over the sorted array, which means opening an index
+    and the memory each worker holds in Python objects scale with the append
+    segment only, never with the size of the base segment.
+
+    Vectors are stored as float32, or float16 to halve the footprint.
+    ``upsert``, ``query`` and ``delete`` take NumPy arrays directly, the
+    same interface as ``PineconeIndex`` in vector_store.py.
+    """
+
+    def __init__(self, directory, dimension, dtype="float32", id_bytes=64,
+                 compact_min_rows=10000, compact_ratio=0.5):
+        self.directory = directory
+        self.dimension = dimension
+        self.compact_min_rows = compact_min_rows
+        self.compact_ratio = compact_ratio
+        self.dtype = np.dtype(dtype)
+        if self.dtype not in (np.float32, np.float16):
+            raise ValueError(f"Unsupported vector dtype: {dtype}")
+        self.id_bytes = id_bytes
+
+        os.makedirs(directory, exist_ok=True)
+        self._lock_path = os.path.join(directory, "lock")
+        self._manifest_path = os.path.join(directory, "manifest.json")
+        self._mutex = threading.Lock()
+        self._generation = None
+        self._manifest_mtime = None
+
+        with self._file_lock(fcntl.LOCK_EX):
+            if not os.path.exists(self._manifest_path):
+                self._write_generation(0, None, np.empty(0, dtype=f"S{id_bytes}"))
+
+    # ---------------------
+    # Public API
+    # ---------------------
+    def upsert(self, ids, vectors):
+        """
+        Insert or overwrite the rows of a ``(len(ids), dimension)`` array.
+        """
+        if not len(ids):
+            return {"upserted_count": 0}
+
+        matrix = normalise(np.asarray(vectors, dtype=np.float32).reshape(len(ids), self.dimension))
+        with self._mutex, self._file_lock(fcntl.LOCK_EX):
+            self._refresh()
+            self._append(matrix, self._encode_ids(ids), deleted=False)
+            self._maybe_compact()
+        return {"upserted_count": len(ids)}
+
+    def delete(self, ids):
+        """
+        Remove vectors by id. Deletions are recorded as tombstones in the
+        append segment and dropped for good at the next compaction.
+        """
+        if not ids:
+            return {}
+
+        matrix = np.zeros((len(ids), self.dimension), dtype=self.dtype)
+        with self._mutex, self._file_lock(fcntl.LOCK_EX):
+            self._refresh()
+            self._append(matrix, self._encode_ids(ids), deleted=True)
+            self._maybe_compact()
+        return {}
+
+    def query(self, vector, top_k=5):
+        """
+        Return the ``top_k`` nearest live vectors by cosine similarity.
+        """
+        query = normalise(np.asarray(vector, dtype=np.float32).reshape(1, -1))[0]
+
+        with self._mutex:
+            with self._file_lock(fcntl.LOCK_SH):
+                self._refresh()
+            base, base_ids, base_dead = self._base, self._base_ids, self._base_dead_rows()
+            append, append_ids, append_live = self._append_vectors, self._append_ids, self._append_live
+
+        parts = []
+        if base is not None:
+            scores = self._scores(base, query)
+            scores[base_dead] = -np.inf
+            parts.append(scores)
+        if append is not None:
+            parts.append(np.where(append_live, self._scores(append, query), -np.inf))
+        if not parts:
+            return {"matches": []}
+
+        scores = np.concatenate(parts) if len(parts) > 1 else parts[0]
+        base_rows = len(base) if base is not None else 0
+        matches = []
+        for row in top_k_rows(scores, top_k):
+            if not np.isfinite(scores[row]):
+                break
+            key = base_ids[row] if row < base_rows else append_ids[row - base_rows]["id"]
+            matches.append({"id": key.decode("utf-8"), "score": float(scores[row])})
+        return {"matches": matches}
+
+    def fetch(self, ids):
+        """
+        Stored vectors by id, as a dict of rows. Unknown or deleted ids are
+        left out.
+        """
+        with self._mutex:
+            with self._file_lock(fcntl.LOCK_SH):
+                self._refresh()
+            keys = self._encode_ids(ids)
+            appended = [self._append_latest.get(key) for key in keys]
+            base_rows = self._find_base_rows(keys)
+            base, append = self._base, self._append_vectors
+            append_live, base_dead = self._append_live, self._base_dead
+
+        vectors = {}
+        for vector_id, append_row, base_row in zip(ids, appended, base_rows):
+            if append_row is not None:
+                if append_live[append_row]:
+                    vectors[vector_id] = append[append_row]
+            elif base_row >= 0 and base_row not in base_dead:
+                vectors[vector_id] = base[base_row]
+        return vectors
+
+    def describe_index_stats(self):
+        """
+        Report row counts, mirroring Pinecone's method of the same name.
+        """
+        with self._mutex:
+            with self._file_lock(fcntl.LOCK_SH):
+                self._refresh()
+            return {
+                "dimension": self.dimension,
+                "total_vector_count": self._base_rows - len(self._base_dead) + int(self._append_live.sum()),
+                "base_rows": self._base_rows,
+                "append_rows": self._append_rows,
+                "generation": self._generation,
+            }
+
+    # ---------------------
+    # Segment management
+    # ---------------------
+    @contextmanager
+    def _file_lock(self, mode):
+        with open(self._lock_path, "a") as handle:
+            fcntl.flock(handle, mode)
+            try:
+                yield
+            finally:
+                fcntl.flock(handle, fcntl.LOCK_UN)
+
+    def _path(self, kind, generation):
+        name = {
+            "base": "base-{}.npy",
+            "base_ids": "base-{}.ids.npy",
+            "append": "append-{}.f32",
+            "append_ids": "append-{}.ids",
+        }[kind]
+        return os.path.join(self.directory, name.format(generation))
+
+    def _encode_ids(self, ids):
+        keys = [vector_id.encode("utf-8") for vector_id in ids]
+        for key in keys:
+            if len(key) > self.id_bytes:
+                raise ValueError(f"Vector id longer than {self.id_bytes} bytes: {key[:32]!r}...")
+        return keys
+
+    def _refresh(self):
+        """
+        Bring the in-memory view up to date with the files on disk.
+        Must be called with the file lock held.
+        """
+        stat = os.stat(self._manifest_path)
+        mtime = (stat.st_ino, stat.st_mtime_ns)
+        if mtime != self._manifest_mtime:
+            with open(self._manifest_path) as f:
+                manifest = json.load(f)
+            if manifest["generation"] != self._generation:
+                self._load_generation(manifest)
+            self._manifest_mtime = mtime
+        self._read_appended()
+
+    def _load_generation(self, manifest):
+        generation = manifest["generation"]
+        if manifest["dimension"] != self.dimension:
+            raise ValueError(
+                f"Index at {self.directory} has dimension {manifest['dimension']}, expected {self.dimension}"
+            )
+        if manifest.get("dtype", "float32") != self.dtype.name:
+            raise ValueError(
+                f"Index at {self.directory} stores {manifest.get('dtype', 'float32')}, expected {self.dtype.name}"
+            )
+
+        if "id_bytes" not in manifest:
+            raise ValueError(
+                f"Index at {self.directory} uses the old JSON id format; delete it and re-ingest"
+            )
+        # The on-disk id width wins over the constructor default
+        self.id_bytes = manifest["id_bytes"]
+        self._record_dtype = np.dtype([("deleted", "u1"), ("id", f"S{self.id_bytes}")])
+
+        self._generation = generation
+        self._base_rows = manifest["base_rows"]
+        self._base = self._base_ids = None
+        if self._base_rows:
+            self._base = np.load(self._path("base", generation), mmap_mode="r")
+            self._base_ids = np.load(self._path("base_ids", generation), mmap_mode="r")
+
+        # Per-worker state below is bounded by the append segment
+        self._base_dead = set()
+        self._base_dead_array = None
+        self._append_latest = {}
+        self._append_live = np.zeros(0, dtype=bool)
+        self._append_ids = self._append_vectors = None
+        self._append_rows = 0
+
+    def _find_base_rows(self, keys):
+        """
+        Base row of each id, or -1, by binary search over the sorted ids.
+        """
+        if self._base_ids is None or not keys:
+            return np.full(len(keys), -1)
+        keys = np.array(keys, dtype=self._base_ids.dtype)
+        rows = np.searchsorted(self._base_ids, keys)
+        found = rows < self._base_rows
+        found[found] = self._base_ids[rows[found]] == keys[found]
+        return np.where(found, rows, -1)
+
+    def _base_dead_rows(self):
+        if self._base_dead_array is None:
+            self._base_dead_array = np.fromiter(self._base_dead, dtype=np.intp, count=len(self._base_dead))
+        return self._base_dead_array
+
+    def _read_appended(self):
+        path = self._path("append_ids", self._generation)
+        # Only whole records count; a concurrent writer may be mid-record.
+        rows = os.path.getsize(path) // self._record_dtype.itemsize
+        if rows <= self._append_rows:
+            return
+
+        records = np.memmap(path, dtype=self._record_dtype, mode="r", shape=(rows,))
+        new = records[self._append_rows:]
+        keys = new["id"].tolist()
+
+        base_rows = self._find_base_rows(keys)
+        self._base_dead.update(int(row) for row in base_rows[base_rows >= 0])
+        self._base_dead_array = None
+
+        live = np.concatenate([self._append_live, new["deleted"] == 0])
+        for row, key in enumerate(keys, start=self._append_rows):
+            previous = self._append_latest.get(key)
+            if previous is not None:
+                live[previous] = False
+            self._append_latest[key] = row
+
+        self._append_live = live
+        self._append_ids = records
+        self._append_vectors = np.memmap(
+            self._path("append", self._generation),
+            dtype=self.dtype,
+            mode="r",
+            shape=(rows, self.dimension),
+        )
+        self._append_rows = rows
+
+    def _append(self, matrix, keys, deleted):
+        """
+        Append rows and their id records. Must be called with the exclusive
+        file lock held, right after ``_refresh``.
+        """
+        vectors_path = self._path("append", self._generation)
+        ids_path = self._path("append_ids", self._generation)
+
+        # Row N of the vector file belongs to id record N. Drop anything a
+        # failed or interrupted writer left past the last complete record,
+        # otherwise every later id would be paired with the wrong vector.
+        os.truncate(vectors_path, self._append_rows * self.dimension * self.dtype.itemsize)
+        os.truncate(ids_path, self._append_rows * self._record_dtype.itemsize)
+
+        records = np.empty(len(keys), dtype=self._record_dtype)
+        records["deleted"] = 1 if deleted else 0
+        records["id"] = keys
+
+        # Vectors are written before ids so readers never see an id whose
+        # row is missing from the vector file.
+        matrix = np.ascontiguousarray(matrix, dtype=self.dtype)
+        with open(vectors_path, "ab") as f:
+            f.write(matrix.data)
+        with open(ids_path, "ab") as f:
+            f.write(records.data)
+        self._read_appended()
+
+    def _maybe_compact(self):
+        if self._append_rows < max(self.compact_min_rows, self._base_rows * self.compact_ratio):
+            return
+        self._compact()
+
+    def _compact(self, block_rows=65536):
+        """
+        Rewrite all live rows, sorted by id, into a fresh base segment.
+        Must be called with the exclusive file lock held.
+        """
+        base_live = np.setdiff1d(np.arange(self._base_rows), self._base_dead_rows())
+        append_live = np.flatnonzero(self._append_live)
+
+        id_parts = []
+        if len(base_live):
+            id_parts.append(self._base_ids[base_live])
+        if len(append_live):
+            id_parts.append(self._append_ids["id"][append_live])
+        ids = np.concatenate(id_parts).astype(f"S{self.id_bytes}") if id_parts else np.empty(0, dtype=f"S{self.id_bytes}")
+        order = np.argsort(ids, kind="stable")
+
+        def gather(rows):
+            # rows index the concatenation of live base rows and live append rows
+            out = np.empty((len(rows), self.dimension), dtype=self.dtype)
+            from_base = rows < len(base_live)
+            if from_base.any():
+                out[from_base] = self._base[base_live[rows[from_base]]]
+            if (~from_base).any():
+                out[~from_base] = self._append_vectors[append_live[rows[~from_base] - len(base_live)]]
+            return out
+
+        old_generation = self._generation
+        self._write_generation(old_generation + 1, (order, gather, block_rows), ids[order])
+        for kind in ("base", "base_ids", "append", "append_ids"):
+            # Other workers may still map the old files; unlinking keeps their
+            # pages valid until they reopen the new generation.
+            try:
+                os.remove(self._path(kind, old_generation))
+            except FileNotFoundError:
+                pass
+        self._refresh()
+
+    def _write_generation(self, generation, rows, ids):
+        """
+        Write a base segment and empty append files, then publish them by
+        replacing the manifest. ``rows`` is None for an empty segment or an
+        ``(order, gather, block_rows)`` tuple streaming vectors in blocks.
+        """
+        base_path = self._path("base", generation)
+        tmp_path = base_path + ".tmp.npy"
+        if len(ids):
+            order, gather, block_rows = rows
+            out = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=self.dtype, shape=(len(ids), self.dimension))
+            for i in range(0, len(ids), block_rows):
+                out[i:i + block_rows] = gather(order[i:i + block_rows])
+            out.flush()
+            del out
+        else:
+            np.save(tmp_path, np.empty((0, self.dimension), dtype=self.dtype))
+        os.replace(tmp_path, base_path)
+
+        ids_path = self._path("base_ids", generation)
+        np.save(ids_path + ".tmp.npy", ids)
+        os.replace(ids_path + ".tmp.npy", ids_path)
+
+        open(self._path("append", generation), "wb").close()
+        open(self._path("append_ids", generation), "wb").close()
+
+        manifest = {
+            "generation": generation,
+            "dimension": self.dimension,
+            "dtype": self.dtype.name,
+            "id_bytes": self.id_bytes,
+            "base_rows": len(ids),
+        }
+        with open(self._manifest_path + ".tmp", "w") as f:
+            json.dump(manifest, f)
+        os.replace(self._manifest_path + ".tmp", self._manifest_path)
+
+    @staticmethod
+    def _scores(segment, query, block_rows=65536):
+        if segment.dtype == np.float32:
+            return segment @ query
+        # NumPy has no BLAS path for float16; upcast a block at a time so a
+        # query never materialises a float32 copy of the whole segment.
+        return np.concatenate([
+            segment[i:i + block_rows].astype(np.float32) @ query
+            for i in range(0, len(segment), block_rows)
+        ])
+
+
+def normalise(matrix):
+    """
+    L2-normalise the rows of a matrix, leaving zero rows as they are.
+    """
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    # Embeddings usually arrive normalised already; avoid the copy then
+    if np.allclose(norms, 1.0, atol=1e-4):
+        return matrix
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+def top_k_rows(scores, top_k):
+    """
+    Indices of the ``top_k`` highest scores, best first.
+    """
+    if top_k >= len(scores):
+        return np.argsort(-scores)
+    candidates = np.argpartition(-scores, top_k)[:top_k]
+    return candidates[np.argsort(-scores[candidates])]
+
+def batch_top_k(queries, matrix, top_k):
+    """
+    Row indices of the ``top_k`` most cosine-similar rows of ``matrix`` for
+    every query, best first, computed with one matrix product.
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    # An empty question list encodes to shape (0,), not (0, dimension)
+    queries = np.asarray(queries, dtype=np.float32).reshape(-1, matrix.shape[1])
+    top_k = min(top_k, len(matrix))
+    if top_k == 0 or len(queries) == 0:
+        return np.empty((len(queries), 0), dtype=np.intp)
+
+    matrix = normalise(matrix)
+    queries = normalise(queries)
+    scores = queries @ matrix.T
+
+    if top_k < len(matrix):
+        candidates = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+    else:
+        candidates = np.broadcast_to(np.arange(len(matrix)), scores.shape)
+    candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+    order = np.argsort(-candidate_scores, axis=1)
+    return np.take_along_axis(candidates, order, axis=1)
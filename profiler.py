@@ -0,0 +1,161 @@
+import asyncio
+import contextvars
+import cProfile
+import os
+import pstats
+import random
+import re
+import threading
+import uuid
+from datetime import datetime
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Profiling is off unless a token is configured; the same token guards
+# the download endpoints, so sampling without one is refused
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "50"))
+PROFILING_ENABLED = bool(PROFILE_TOKEN)
+
+if PROFILE_SAMPLE_RATE > 0 and not PROFILE_TOKEN:
+    print("PROFILE_SAMPLE_RATE is ignored: set PROFILE_TOKEN so sampled profiles can be downloaded")
+    PROFILE_SAMPLE_RATE = 0.0
+
+PROFILE_NAME = re.compile(r"^[\w.-]+\.prof$")
+
+# The profile of the request being handled in the current context, if any.
+# asyncio tasks and to_thread calls inherit it, concurrent requests do not.
+_current = contextvars.ContextVar("request_profile", default=None)
+
+class RequestProfile:
+    """
+    Collects the profiles of one request's worker-thread calls.
+
+    cProfile only sees the thread it was enabled on, and the expensive work
+    (parsing, embedding, vector-store calls) runs in ``asyncio.to_thread``
+    while the event-loop thread is shared by every request. So each call
+    made through ``to_thread`` below gets its own profiler, and the results
+    are merged when the request finishes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._profiles = []
+        self._token = None
+        self.finished = False
+
+    def run(self, func, *args, **kwargs):
+        if self.finished:
+            # e.g. a background task still running after the response
+            return func(*args, **kwargs)
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another tool (debugger, coverage) already owns the profiler hook
+            return func(*args, **kwargs)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profile.disable()
+            with self._lock:
+                self._profiles.append(profile)
+
+    def stats(self):
+        """
+        The merged profile, or None if nothing was profiled.
+        """
+        with self._lock:
+            profiles = list(self._profiles)
+        if not profiles:
+            return None
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        return stats
+
+def should_profile(headers):
+    """
+    Profile when the request carries ``X-Profile: <PROFILE_TOKEN>`` or
+    falls within the sampling percentage.
+    """
+    if PROFILE_TOKEN and headers.get("x-profile") == PROFILE_TOKEN:
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+def start_profile():
+    """
+    Mark the current request as profiled and return its RequestProfile.
+    """
+    request_profile = RequestProfile()
+    request_profile._token = _current.set(request_profile)
+    return request_profile
+
+def finish_profile(request_profile, label):
+    """
+    Stop profiling a request, write its merged profile to PROFILE_DIR and
+    return the file name, or None if it ran nothing on worker threads.
+    The oldest profiles are removed beyond PROFILE_MAX_FILES.
+    """
+    _current.reset(request_profile._token)
+    request_profile.finished = True
+    stats = request_profile.stats()
+    if stats is None:
+        return None
+
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    slug = re.sub(r"[^\w]+", "-", label).strip("-") or "request"
+    name = f"{datetime.utcnow():%Y%m%dT%H%M%S}-{slug}-{uuid.uuid4().hex[:8]}.prof"
+    stats.dump_stats(os.path.join(PROFILE_DIR, name))
+    _prune()
+    return name
+
+async def to_thread(func, /, *args, **kwargs):
+    """
+    ``asyncio.to_thread`` that profiles ``func`` when the current request
+    is being profiled.
+    """
+    request_profile = _current.get()
+    if request_profile is None:
+        return await asyncio.to_thread(func, *args, **kwargs)
+    return await asyncio.to_thread(request_profile.run, func, *args, **kwargs)
+
+def list_profiles():
+    """
+    Stored profiles, newest first.
+    """
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    entries = [
+        (entry.name, entry.stat())
+        for entry in os.scandir(PROFILE_DIR)
+        if entry.is_file() and PROFILE_NAME.match(entry.name)
+    ]
+    entries.sort(key=lambda item: item[1].st_mtime_ns, reverse=True)
+    return [
+        {
+            "name": name,
+            "size": stat.st_size,
+            "created_at": datetime.utcfromtimestamp(stat.st_mtime).isoformat()
+        }
+        for name, stat in entries
+    ]
+
+def profile_path(name):
+    """
+    Path of a stored profile, or None if the name is invalid or missing.
+    """
+    if not PROFILE_NAME.match(name):
+        return None
+    path = os.path.join(PROFILE_DIR, name)
+    return path if os.path.isfile(path) else None
+
+def _prune():
+    for profile in list_profiles()[PROFILE_MAX_FILES:]:
+        try:
+            os.remove(os.path.join(PROFILE_DIR, profile["name"]))
+        except OSError:
+            pass
@@ -1,6 +1,8 @@
+import asyncio
 import os
 import openai
 from dotenv import load_dotenv
+from llm_scheduler import scheduler, estimate_tokens, retry_after
 
 # Load environment variables from .env file
 load_dotenv()
@@ -25,17 +27,55 @@ Return your decision in JSON with:
 - justification: explanation with clause references
 """
 
-def ask_llm(prompt, model="gpt-4o-mini"):  # or "gpt-3.5-turbo"
+SYSTEM_PROMPT = "You are a helpful assistant that answers policy-related queries from documents."
+MAX_TOKENS = 700
+
+class LLMUnavailable(Exception):
+    """
+    Raised when the LLM call fails after the scheduler's retries; the
+    client should retry after ``retry_after`` seconds.
+    """
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+async def ask_llm(prompt, model="gpt-4o-mini", priority=0):  # or "gpt-3.5-turbo"
+    """
+    Ask the LLM through the shared scheduler, which enforces the rate
+    limits and retries throttled or failed calls. Lower ``priority``
+    values are served first. Raises LLMUnavailable if the call fails.
+    """
     try:
-        response = openai.ChatCompletion.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant that answers policy-related queries from documents."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.3,
-            max_tokens=700
+        response = await scheduler.submit(
+            lambda: openai.ChatCompletion.create(
+                model=model,
+                messages=[
+                    {"role": "system", "content": SYSTEM_PROMPT},
+                    {"role": "user", "content": prompt}
+                ],
+                temperature=0.3,
+                max_tokens=MAX_TOKENS
+            ),
+            estimated_tokens=estimate_tokens(SYSTEM_PROMPT + prompt, MAX_TOKENS),
+            priority=priority
         )
-        return response.choices[0].message["content"].strip()
     except Exception as e:
-        return f"LLM Error: {str(e)}"
+        raise LLMUnavailable(f"LLM Error: {e}", retry_after(e)) from e
+    return response.choices[0].message["content"].strip()
+
+async def ask_llm_batch(prompts, model="gpt-4o-mini"):
+    """
+    Ask several prompts concurrently, prioritised by their position. If one
+    fails the others are cancelled, so a request that is going to fail
+    anyway stops spending the shared rate-limit budget.
+    """
+    try:
+        async with asyncio.TaskGroup() as group:
+            tasks = [
+                group.create_task(ask_llm(prompt, model=model, priority=i))
+                for i, prompt in enumerate(prompts)
+            ]
+    except* LLMUnavailable as errors:
+        raise errors.exceptions[0] from None
+    return [task.result() for task in tasks]
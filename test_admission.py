@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+Tests for per-endpoint admission control
+"""
+
+import asyncio
+import pytest
+from admission import AdmissionController, AdmissionRejected
+
+async def hold(controller, release, cost=1):
+    async with controller.admit(cost):
+        await release.wait()
+
+def test_full_queue_is_rejected_with_retry_after():
+    async def run():
+        controller = AdmissionController("test", capacity=1, max_queue=1, max_wait=5)
+        release = asyncio.Event()
+        running = asyncio.create_task(hold(controller, release))
+        queued = asyncio.create_task(hold(controller, release))
+        await asyncio.sleep(0)
+        assert controller.stats()["queued"] == 1
+
+        with pytest.raises(AdmissionRejected) as rejected:
+            async with controller.admit():
+                pass
+        assert rejected.value.retry_after >= 1
+        assert controller.rejected == 1
+
+        release.set()
+        await asyncio.gather(running, queued)
+        assert controller.stats()["in_use"] == 0
+
+    asyncio.run(run())
+
+def test_waiter_times_out_after_max_wait():
+    async def run():
+        controller = AdmissionController("test", capacity=1, max_queue=4, max_wait=0.05)
+        release = asyncio.Event()
+        running = asyncio.create_task(hold(controller, release))
+        await asyncio.sleep(0)
+
+        with pytest.raises(AdmissionRejected):
+            async with controller.admit():
+                pass
+        stats = controller.stats()
+        assert stats["queued"] == 0 and stats["in_use"] == 1
+
+        release.set()
+        await running
+        assert controller.stats()["in_use"] == 0
+
+    asyncio.run(run())
+
+def test_waiter_cancelled_while_granted_releases_its_slot():
+    async def run():
+        controller = AdmissionController("test", capacity=1, max_queue=4, max_wait=5)
+        slot = controller.admit()
+        await slot.__aenter__()
+        waiter = asyncio.create_task(hold(controller, asyncio.Event()))
+        await asyncio.sleep(0)
+        assert controller.stats()["queued"] == 1
+
+        # Releasing hands the slot to the waiter; cancel it before it resumes
+        await slot.__aexit__(None, None, None)
+        assert controller.stats()["in_use"] == 1
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert controller.stats()["in_use"] == 0
+
+        # The slot is really free again
+        async with controller.admit() as waited:
+            assert waited < 0.1
+
+    asyncio.run(run())
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""
+Tests for the embedding server client
+"""
+
+import socket
+import threading
+import time
+import pytest
+from embedding_server import EmbeddingClient, recv_message, send_message
+
+def hung_server(path):
+    """
+    Answer the client's info request, then never reply again.
+    """
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen()
+
+    def serve():
+        conn, _ = server.accept()
+        recv_message(conn)
+        send_message(conn, {"ok": True, "dim": 4, "model": "stub"})
+        while conn.recv(65536):
+            pass
+
+    threading.Thread(target=serve, daemon=True).start()
+    return server
+
+def test_client_times_out_on_a_hung_server(tmp_path):
+    path = str(tmp_path / "embed.sock")
+    server = hung_server(path)
+    try:
+        client = EmbeddingClient(path, timeout=0.2)
+        assert client.dimension == 4
+
+        started = time.monotonic()
+        with pytest.raises(TimeoutError):
+            client.encode(["a sentence"])
+        assert time.monotonic() - started < 2
+        # The out-of-step connection is dropped
+        assert client._local.conn is None
+    finally:
+        server.close()
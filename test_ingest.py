@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Tests for document identity and the bulk ingestion pipeline
+"""
+
+import asyncio
+import os
+import numpy as np
+import pytest
+import ingest
+from ingest import document_source, ingest_documents
+from vector_store import EMBEDDING_DIM
+
+@pytest.mark.parametrize("first, second", [
+    # Ordinary parameters that happen to share a name with a signature field
+    ("https://insurer.example/download?policy=A123", "https://insurer.example/download?policy=B456"),
+    ("https://insurer.example/get?doc=7&st=active", "https://insurer.example/get?doc=7&st=draft"),
+    ("https://insurer.example/get?id=1&signature=x", "https://insurer.example/get?id=2&signature=x"),
+])
+def test_distinct_documents_keep_distinct_sources(first, second):
+    assert document_source(first) != document_source(second)
+
+@pytest.mark.parametrize("first, second, expected", [
+    (
+        "https://acct.blob.core.windows.net/c/a.pdf?sv=2023-01-03&st=1&se=2&sr=b&sp=r&sig=abc",
+        "https://acct.blob.core.windows.net/c/a.pdf?sv=2023-01-03&st=3&se=4&sr=b&sp=r&sig=def",
+        "https://acct.blob.core.windows.net/c/a.pdf",
+    ),
+    (
+        "https://bucket.s3.amazonaws.com/a.pdf?id=7&X-Amz-Date=1&X-Amz-Signature=abc",
+        "https://bucket.s3.amazonaws.com/a.pdf?X-Amz-Signature=def&X-Amz-Date=2&id=7",
+        "https://bucket.s3.amazonaws.com/a.pdf?id=7",
+    ),
+    (
+        "https://d1.cloudfront.net/a.pdf?Policy=p1&Signature=s1&Key-Pair-Id=K",
+        "https://d1.cloudfront.net/a.pdf?Expires=9&Signature=s2&Key-Pair-Id=K",
+        "https://d1.cloudfront.net/a.pdf",
+    ),
+])
+def test_signed_links_to_one_file_share_a_source(first, second, expected):
+    assert document_source(first) == document_source(second) == expected
+
+def parse_or_die(path):
+    """
+    Parser stand-in for the spawned workers: kills its process on files
+    named like a pathological PDF.
+    """
+    if "crash" in os.path.basename(path):
+        os._exit(1)
+    with open(path) as f:
+        return [f.read()]
+
+class OnesEncoder:
+    def encode(self, texts, convert_to_numpy=True):
+        return np.ones((len(texts), EMBEDDING_DIM), dtype=np.float32)
+
+def spooled(tmp_path, name, text):
+    path = tmp_path / name
+    path.write_text(text)
+    return {"source": f"pool-test/{name}", "path": str(path)}
+
+def test_dead_parser_fails_only_its_document(tmp_path, monkeypatch):
+    monkeypatch.setattr(ingest, "get_pdf_pages", parse_or_die)
+    items = [spooled(tmp_path, f"doc-{i}.txt", f"document {i} " * 20) for i in range(3)]
+    items.insert(1, spooled(tmp_path, "crash.txt", "never parsed"))
+
+    report = asyncio.run(ingest_documents(items, OnesEncoder(), max_bytes=1 << 20))
+    statuses = {doc["source"]: doc["status"] for doc in report["documents"]}
+    assert statuses.pop("pool-test/crash.txt") == "failed"
+    assert set(statuses.values()) == {"indexed"}
+
+    # The worker keeps ingesting after the crash
+    again = asyncio.run(ingest_documents(
+        [spooled(tmp_path, "after.txt", "after the crash " * 20)], OnesEncoder(), max_bytes=1 << 20
+    ))
+    assert again["indexed"] == 1
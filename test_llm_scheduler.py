@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Tests for the LLM scheduler and the batch question helper
+"""
+
+import asyncio
+import threading
+import pytest
+import query_handler
+from llm_scheduler import LLMScheduler
+
+class APIError(Exception):
+    def __init__(self, status):
+        super().__init__(f"HTTP {status}")
+        self.http_status = status
+
+def test_throttled_call_is_retried_and_halves_concurrency():
+    scheduler = LLMScheduler(requests_per_minute=6000, tokens_per_minute=10 ** 9, max_concurrency=4,
+                             base_delay=0.01, max_delay=0.05)
+    attempts = []
+
+    def call():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise APIError(429)
+        return {"usage": {"total_tokens": 10}}
+
+    result = asyncio.run(scheduler.submit(call, estimated_tokens=10))
+    assert result == {"usage": {"total_tokens": 10}}
+    stats = scheduler.snapshot()
+    assert len(attempts) == 2
+    assert stats["retries"] == 1 and stats["throttled"] == 1 and stats["failed"] == 0
+    assert stats["concurrency"] == 2
+
+def test_client_errors_are_not_retried():
+    scheduler = LLMScheduler(requests_per_minute=6000, tokens_per_minute=10 ** 9, max_concurrency=4)
+
+    def call():
+        raise APIError(400)
+
+    with pytest.raises(APIError):
+        asyncio.run(scheduler.submit(call, estimated_tokens=10))
+    assert scheduler.snapshot()["retries"] == 0 and scheduler.snapshot()["failed"] == 1
+
+def test_lower_priority_numbers_are_served_first():
+    scheduler = LLMScheduler(requests_per_minute=6000, tokens_per_minute=10 ** 9, max_concurrency=1)
+    order = []
+    blocker = threading.Event()
+
+    def call(tag):
+        def run():
+            if tag == "first":
+                blocker.wait(5)
+            order.append(tag)
+        return run
+
+    async def run():
+        # The first call holds the only slot while the rest queue up
+        tasks = [asyncio.create_task(scheduler.submit(call("first"), 1))]
+        await asyncio.sleep(0.01)
+        for priority in (5, 3, 1, 4, 2):
+            tasks.append(asyncio.create_task(scheduler.submit(call(priority), 1, priority=priority)))
+        await asyncio.sleep(0.01)
+        assert scheduler.snapshot()["queued"] == 5
+        blocker.set()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(run())
+    assert order == ["first", 1, 2, 3, 4, 5]
+
+def test_failed_question_cancels_its_siblings(monkeypatch):
+    scheduler = LLMScheduler(requests_per_minute=600, tokens_per_minute=10 ** 9, max_concurrency=1, max_retries=0)
+    prompts = []
+
+    def create(messages, **kwargs):
+        prompts.append(messages[-1]["content"])
+        raise APIError(400)
+
+    monkeypatch.setattr(query_handler, "scheduler", scheduler)
+    monkeypatch.setattr(query_handler.openai.ChatCompletion, "create", create)
+
+    async def run():
+        with pytest.raises(query_handler.LLMUnavailable):
+            await query_handler.ask_llm_batch(["first", "second", "third"])
+        # Give any surviving sibling time to reach the API
+        await asyncio.sleep(0.2)
+
+    asyncio.run(run())
+    # The queued questions never reached the API
+    assert prompts == ["first"]
+    assert scheduler.snapshot()["queued"] == 0
+    assert scheduler.snapshot()["in_flight"] == 0
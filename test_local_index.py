@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Tests for the memory-mapped local vector index
+"""
+
+import numpy as np
+import pytest
+from local_index import LocalVectorIndex, batch_top_k
+
+DIM = 4
+
+def unit(*values):
+    return np.array([values], dtype=np.float32)
+
+def top_match(index, vector):
+    matches = index.query(vector, top_k=1)["matches"]
+    return (matches[0]["id"], round(matches[0]["score"], 3)) if matches else None
+
+def test_upsert_overwrite_and_delete(tmp_path):
+    index = LocalVectorIndex(str(tmp_path), DIM)
+    index.upsert(["a", "b"], np.eye(DIM, dtype=np.float32)[:2])
+    assert top_match(index, unit(1, 0, 0, 0)) == ("a", 1.0)
+
+    # Overwriting moves "a"; the old row must no longer match
+    index.upsert(["a"], unit(0, 0, 1, 0))
+    assert top_match(index, unit(0, 0, 1, 0)) == ("a", 1.0)
+    assert top_match(index, unit(1, 0, 0, 0)) != ("a", 1.0)
+
+    index.delete(["b"])
+    assert [m["id"] for m in index.query(unit(0, 1, 0, 0), top_k=5)["matches"]] == ["a"]
+    assert index.describe_index_stats()["total_vector_count"] == 1
+
+@pytest.mark.parametrize("dtype", ["float32", "float16"])
+def test_compaction_and_reopen(tmp_path, dtype):
+    index = LocalVectorIndex(str(tmp_path), DIM, dtype=dtype, compact_min_rows=3)
+    index.upsert(["a", "b"], np.eye(DIM, dtype=np.float32)[:2])
+    index.upsert(["c"], unit(0, 0, 1, 0))
+    index.delete(["b"])
+    index.upsert(["d"], unit(0, 0, 0, 1))
+
+    stats = index.describe_index_stats()
+    assert stats["generation"] >= 1
+    assert stats["total_vector_count"] == 3
+
+    # A second process opening the same directory sees the same index
+    reopened = LocalVectorIndex(str(tmp_path), DIM, dtype=dtype, compact_min_rows=3)
+    assert top_match(reopened, unit(1, 0, 0, 0)) == ("a", 1.0)
+    assert top_match(reopened, unit(0, 0, 1, 0)) == ("c", 1.0)
+    assert top_match(reopened, unit(0, 0, 0, 1)) == ("d", 1.0)
+    assert "b" not in reopened.fetch(["a", "b", "c", "d"])
+
+    # Writes from one instance are visible to the other
+    reopened.upsert(["e"], unit(1, 1, 0, 0))
+    assert top_match(index, unit(1, 1, 0, 0)) == ("e", 1.0)
+
+def test_reopen_rejects_other_dtype(tmp_path):
+    LocalVectorIndex(str(tmp_path), DIM).upsert(["a"], unit(1, 0, 0, 0))
+    with pytest.raises(ValueError):
+        LocalVectorIndex(str(tmp_path), DIM, dtype="float16").query(unit(1, 0, 0, 0))
+
+def test_interrupted_append_does_not_shift_ids(tmp_path):
+    index = LocalVectorIndex(str(tmp_path), DIM)
+    index.upsert(["a", "b"], np.eye(DIM, dtype=np.float32)[:2])
+
+    # Simulate a writer that died after writing its vectors but before
+    # (or part-way through) writing their id records
+    generation = index.describe_index_stats()["generation"]
+    with open(tmp_path / f"append-{generation}.f32", "ab") as f:
+        f.write(np.ones((3, DIM), dtype=np.float32).tobytes())
+    with open(tmp_path / f"append-{generation}.ids", "ab") as f:
+        f.write(b"\x00gho")
+
+    index.upsert(["d"], unit(0, 0, 1, 0))
+    assert top_match(index, unit(0, 0, 1, 0)) == ("d", 1.0)
+    assert top_match(index, unit(1, 0, 0, 0)) == ("a", 1.0)
+
+    reopened = LocalVectorIndex(str(tmp_path), DIM)
+    assert top_match(reopened, unit(0, 0, 1, 0)) == ("d", 1.0)
+    assert reopened.describe_index_stats()["total_vector_count"] == 3
+
+def test_updates_to_compacted_rows(tmp_path):
+    index = LocalVectorIndex(str(tmp_path), DIM, compact_min_rows=4)
+    index.upsert(["d", "b", "c", "a"], np.eye(DIM, dtype=np.float32))
+    assert index.describe_index_stats()["base_rows"] == 4
+
+    # Base ids are found by binary search; appended rows shadow them
+    index.upsert(["c"], unit(1, 1, 0, 0))
+    index.delete(["a"])
+    reopened = LocalVectorIndex(str(tmp_path), DIM, compact_min_rows=4)
+    for view in (index, reopened):
+        assert top_match(view, unit(1, 1, 0, 0)) == ("c", 1.0)
+        assert sorted(view.fetch(["a", "b", "c", "d", "x"])) == ["b", "c", "d"]
+        assert view.describe_index_stats()["total_vector_count"] == 3
+
+def test_rejects_ids_wider_than_the_index(tmp_path):
+    index = LocalVectorIndex(str(tmp_path), DIM, id_bytes=8)
+    with pytest.raises(ValueError):
+        index.upsert(["x" * 9], unit(1, 0, 0, 0))
+    index.upsert(["x" * 8], unit(1, 0, 0, 0))
+    assert top_match(index, unit(1, 0, 0, 0)) == ("x" * 8, 1.0)
+
+def test_batch_top_k():
+    matrix = np.eye(DIM, dtype=np.float32)
+    queries = np.array([[0, 0.9, 0.1, 0], [1, 0, 0, 0.5]], dtype=np.float32)
+    assert batch_top_k(queries, matrix, 2).tolist() == [[1, 2], [0, 3]]
+    # A single query vector and an empty question list
+    assert batch_top_k(queries[0], matrix, 1).tolist() == [[1]]
+    assert batch_top_k(np.empty(0, dtype=np.float32), matrix, 5).shape == (0, 0)
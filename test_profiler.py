@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Tests for per-request profiling of worker-thread calls
+"""
+
+import asyncio
+import io
+import os
+import pstats
+from PyPDF2 import PdfWriter
+import profiler
+from embedder import get_pdf_pages
+
+def blank_pdf(pages=3):
+    writer = PdfWriter()
+    for _ in range(pages):
+        writer.add_blank_page(width=72, height=72)
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+def unrelated_work():
+    return sum(range(10000))
+
+def profiled_functions(path):
+    return {name for _, _, name in pstats.Stats(path).stats}
+
+def test_profile_contains_worker_thread_calls(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiler, "PROFILE_DIR", str(tmp_path))
+
+    async def profiled_request():
+        request_profile = profiler.start_profile()
+        try:
+            await profiler.to_thread(get_pdf_pages, blank_pdf())
+        finally:
+            name = profiler.finish_profile(request_profile, "/api/v1/hackrx/run")
+        return name
+
+    async def other_request():
+        await profiler.to_thread(unrelated_work)
+
+    async def run():
+        name, _ = await asyncio.gather(profiled_request(), other_request())
+        return name
+
+    name = asyncio.run(run())
+    assert name in [profile["name"] for profile in profiler.list_profiles()]
+    functions = profiled_functions(os.path.join(str(tmp_path), name))
+    assert "get_pdf_pages" in functions
+    # A concurrent request's work stays out of the profile
+    assert "unrelated_work" not in functions
+
+def test_unprofiled_requests_write_nothing(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiler, "PROFILE_DIR", str(tmp_path))
+    assert asyncio.run(profiler.to_thread(get_pdf_pages, blank_pdf(1))) == [""]
+    assert profiler.list_profiles() == []
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Tests for incremental re-indexing against the local vector index
+"""
+
+import zlib
+import numpy as np
+import db
+import vector_store
+from vector_store import plan_ingest, embed_plan, embed_document, apply_plan, EMBEDDING_DIM
+
+class StubEncoder:
+    """
+    Deterministic stand-in for the sentence transformer that records
+    every text it embeds.
+    """
+
+    def __init__(self):
+        self.encoded = []
+
+    def encode(self, texts, convert_to_numpy=True):
+        self.encoded.extend(texts)
+        rows = np.zeros((len(texts), EMBEDDING_DIM), dtype=np.float32)
+        for row, text in zip(rows, texts):
+            row[zlib.crc32(text.encode("utf-8")) % EMBEDDING_DIM] = 1.0
+        return rows
+
+def ingest(pages, source, encoder):
+    plan = plan_ingest(pages, source)
+    if not plan["unchanged"]:
+        apply_plan(plan, embed_plan(plan, encoder))
+    return plan
+
+def page(letter, length=600):
+    return letter * length
+
+def test_reingest_embeds_only_the_edited_page():
+    encoder = StubEncoder()
+    first = ingest([page("a"), page("b"), page("c")], "edited.pdf", encoder)
+    assert len(encoder.encoded) == len(first["chunks"])
+
+    encoder.encoded.clear()
+    second = ingest([page("a"), page("x"), page("c")], "edited.pdf", encoder)
+    assert second["new_chunks"]
+    assert {chunk["page"] for chunk in second["new_chunks"]} == {2}
+    assert encoder.encoded == [chunk["text"] for chunk in second["new_chunks"]]
+
+    # Submitting the same version again embeds nothing
+    encoder.encoded.clear()
+    third = ingest([page("a"), page("x"), page("c")], "edited.pdf", encoder)
+    assert third["unchanged"] and encoder.encoded == []
+
+def test_removed_chunks_leave_the_index():
+    encoder = StubEncoder()
+    first = ingest([page("d"), page("e")], "shrinking.pdf", encoder)
+    second = ingest([page("d")], "shrinking.pdf", encoder)
+
+    removed = {chunk["id"] for chunk in first["chunks"]} - {chunk["id"] for chunk in second["chunks"]}
+    assert removed and set(second["removed_ids"]) == removed
+    assert vector_store.index.fetch(sorted(removed)) == {}
+    assert db.get_chunk_ids(second["document_id"]) == [chunk["id"] for chunk in second["chunks"]]
+    assert set(vector_store.index.fetch(db.get_chunk_ids(second["document_id"]))) == {
+        chunk["id"] for chunk in second["chunks"]
+    }
+
+def test_repeated_text_keeps_stable_occurrence_ids():
+    encoder = StubEncoder()
+    header = "HEADER " * 20
+    first = ingest([header, page("f"), header], "repeated.pdf", encoder)
+    repeated = [chunk["id"] for chunk in first["chunks"] if chunk["text"] == header]
+    assert len(repeated) == 2 and len(set(repeated)) == 2
+    assert [chunk_id.rsplit("-", 1)[1] for chunk_id in repeated] == ["0", "1"]
+
+    # Editing an unrelated page keeps both occurrences' ids, so neither is
+    # re-embedded
+    encoder.encoded.clear()
+    second = ingest([header, page("g"), header], "repeated.pdf", encoder)
+    assert [chunk["id"] for chunk in second["chunks"] if chunk["page"] != 2] == repeated
+    assert header not in encoder.encoded
+
+def test_embed_document_reuses_stored_vectors():
+    encoder = StubEncoder()
+    ingest([page("h"), page("i")], "reused.pdf", encoder)
+
+    encoder.encoded.clear()
+    plan = plan_ingest([page("h"), page("j")], "reused.pdf")
+    matrix, embeddings = embed_document(plan, encoder)
+    assert encoder.encoded == [chunk["text"] for chunk in plan["new_chunks"]]
+    assert matrix.shape == (len(plan["chunks"]), EMBEDDING_DIM)
+    assert np.array_equal(matrix, StubEncoder().encode([chunk["text"] for chunk in plan["chunks"]]))
@@ -1,44 +1,104 @@
+import itertools
 import os
-from pinecone import Pinecone, ServerlessSpec
+import time
+import numpy as np
 from dotenv import load_dotenv
+import db
 
 load_dotenv()
 
-# Load Pinecone API key
-api_key = os.getenv("PINECONE_API_KEY")
-if not api_key:
-    raise ValueError("Missing PINECONE_API_KEY")
-
-# Initialize Pinecone
-pc = Pinecone(api_key=api_key)
-
 # Constants
 INDEX_NAME = "pdf-query-index"
 EMBEDDING_DIM = 384  # all-MiniLM-L6-v2 output size
 
-# Create index if it doesn't exist
-if INDEX_NAME not in pc.list_indexes().names():
-    pc.create_index(
-        name=INDEX_NAME,
-        dimension=EMBEDDING_DIM,
-        metric="cosine",
-        spec=ServerlessSpec(cloud="aws", region="us-east-1")
-    )
+# "pinecone" (default) or "local" for the memory-mapped on-disk index
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "pinecone").lower()
+LOCAL_INDEX_DIR = os.getenv("LOCAL_INDEX_DIR", "vector_index")
+# Storage precision of the local index: "float32" or "float16"
+LOCAL_INDEX_DTYPE = os.getenv("LOCAL_INDEX_DTYPE", "float32")
 
-# Connect to the index
-index = pc.Index(INDEX_NAME)
+# Ids of vectors upserted before chunks were content-hashed
+LEGACY_ID_PREFIX = "chunk-"
 
-def truncate_to_bytes(text, max_bytes=40960):
+class PineconeIndex:
     """
-    Truncate text to max byte length in UTF-8 encoding.
+    Adapt a Pinecone index to the array-based interface of LocalVectorIndex.
+    Vectors become Python lists only here, at the wire boundary.
     """
-    encoded = text.encode("utf-8")
-    if len(encoded) <= max_bytes:
-        return text
-    while len(encoded) > max_bytes:
-        text = text[:-10]
-        encoded = text.encode("utf-8")
-    return text
+
+    def __init__(self, index, batch_size=100, fetch_batch_size=1000):
+        self.index = index
+        self.batch_size = batch_size
+        # Pinecone's limit on ids per fetch request
+        self.fetch_batch_size = fetch_batch_size
+
+    def upsert(self, ids, vectors):
+        for i in range(0, len(ids), self.batch_size):
+            batch = zip(ids[i:i + self.batch_size], vectors[i:i + self.batch_size])
+            self.index.upsert(vectors=[(vector_id, row.tolist()) for vector_id, row in batch])
+
+    def delete(self, ids):
+        self.index.delete(ids=list(ids))
+
+    def list_ids(self, prefix):
+        """
+        Every stored id starting with ``prefix`` (serverless indexes only).
+        """
+        return [vector_id for page in self.index.list(prefix=prefix) for vector_id in page]
+
+    def query(self, vector, top_k=5):
+        return self.index.query(vector=np.asarray(vector, dtype=np.float32).tolist(), top_k=top_k)
+
+    def fetch(self, ids):
+        vectors = {}
+        for i in range(0, len(ids), self.fetch_batch_size):
+            response = self.index.fetch(ids=list(ids[i:i + self.fetch_batch_size]))
+            for vector_id, vector in response["vectors"].items():
+                vectors[vector_id] = np.asarray(vector["values"], dtype=np.float32)
+        return vectors
+
+if VECTOR_BACKEND == "local":
+    from local_index import LocalVectorIndex
+
+    # Shared by every worker through the OS page cache
+    index = LocalVectorIndex(LOCAL_INDEX_DIR, EMBEDDING_DIM, dtype=LOCAL_INDEX_DTYPE)
+else:
+    from pinecone import Pinecone, ServerlessSpec
+
+    # Load Pinecone API key
+    api_key = os.getenv("PINECONE_API_KEY")
+    if not api_key:
+        raise ValueError("Missing PINECONE_API_KEY")
+
+    # Initialize Pinecone
+    pc = Pinecone(api_key=api_key)
+
+    # Create index if it doesn't exist
+    if INDEX_NAME not in pc.list_indexes().names():
+        pc.create_index(
+            name=INDEX_NAME,
+            dimension=EMBEDDING_DIM,
+            metric="cosine",
+            spec=ServerlessSpec(cloud="aws", region="us-east-1")
+        )
+
+    # Connect to the index
+    index = PineconeIndex(pc.Index(INDEX_NAME))
+
+# Smoothed seconds per vector for fetching stored vectors from the index
+# and for embedding chunk text, so embed_document can pick the cheaper way
+# to rebuild a document's matrix
+_vector_costs = {"fetch": None, "embed": None}
+# Fetch anyway for one document in this many, so a stale fetch cost heals
+FETCH_PROBE_INTERVAL = 16
+_documents_embedded = itertools.count()
+
+def _record_cost(kind, seconds, count):
+    if not count:
+        return
+    cost = seconds / count
+    previous = _vector_costs[kind]
+    _vector_costs[kind] = cost if previous is None else 0.8 * previous + 0.2 * cost
 
 def split_text(text, chunk_size=300, overlap=50):
     """
@@ -49,34 +109,234 @@ def split_text(text, chunk_size=300, overlap=50):
         chunks.append(text[i:i + chunk_size])
     return chunks
 
-def embed_and_upsert(text, embed_model):
+def split_pages(pages, chunk_size=300, overlap=50):
     """
-    Split, embed and upsert text chunks into Pinecone.
+    Split each page into overlapping chunks, keeping the page number and
+    character offsets of every chunk.
     """
-    chunks = split_text(text)
-    embeddings = embed_model.encode(chunks).tolist()
-    return upsert_chunks(chunks, embeddings)
+    chunks = []
+    for page_number, page_text in enumerate(pages, start=1):
+        for start in range(0, len(page_text), chunk_size - overlap):
+            text = page_text[start:start + chunk_size]
+            chunks.append({
+                "page": page_number,
+                "start": start,
+                "end": start + len(text),
+                "text": text
+            })
+    return chunks
 
-def upsert_chunks(chunks, embeddings):
+def assign_chunk_ids(document_id, chunks):
+    """
+    Hash every chunk and give it an id derived from its content, so an
+    unchanged chunk keeps its id when other parts of the document change.
+    Repeated text (e.g. page headers) is told apart by occurrence number.
     """
-    Upsert vectorized chunks into Pinecone.
+    seen = {}
+    for chunk in chunks:
+        chunk["hash"] = db.hash_text(chunk["text"])
+        occurrence = seen.get(chunk["hash"], 0)
+        seen[chunk["hash"]] = occurrence + 1
+        chunk["id"] = f"{document_id}-{chunk['hash'][:16]}-{occurrence}"
+    return chunks
+
+def plan_ingest(pages, source="unknown"):
     """
-    vectors = []
-    for i, (chunk, embedding) in enumerate(zip(chunks, embeddings)):
-        safe_text = truncate_to_bytes(chunk)
-        vectors.append({
-            "id": f"chunk-{i}",
-            "values": embedding,
-            "metadata": {"text": safe_text}
-        })
+    Work out what ingesting a document requires without embedding anything.
 
-    # Pinecone upsert
-    index.upsert(vectors=vectors)
+    Chunks are diffed against the stored version by content hash. The
+    returned plan lists every chunk, the chunks that still need embedding
+    and the ids of chunks that disappeared; ``unchanged`` is set when the
+    whole document matches what is already stored.
+    """
+    if isinstance(pages, str):
+        pages = [pages]
+
+    document_id = db.document_id_for(source)
+    plan = {
+        "document_id": document_id,
+        "source": source,
+        "content_hash": db.hash_text("\f".join(pages)),
+        "page_count": len(pages),
+        "chunks": assign_chunk_ids(document_id, split_pages(pages))
+    }
+    return diff_plan(plan)
+
+def diff_plan(plan):
+    """
+    Compare a plan's chunks with the version stored right now and set its
+    ``unchanged``, ``new_chunks`` and ``removed_ids``.
+    """
+    existing = db.get_document(plan["document_id"])
+    old_ids = db.get_chunk_ids(plan["document_id"]) if existing else []
+    old_id_set = set(old_ids)
+    current_ids = {chunk["id"] for chunk in plan["chunks"]}
+    plan["unchanged"] = bool(existing and existing["content_hash"] == plan["content_hash"])
+    plan["new_chunks"] = [chunk for chunk in plan["chunks"] if chunk["id"] not in old_id_set]
+    plan["removed_ids"] = [chunk_id for chunk_id in old_ids if chunk_id not in current_ids]
+    return plan
+
+def embed_plan(plan, embed_model):
+    """
+    Embed the chunks an ingest plan still needs.
+    """
+    if not plan["new_chunks"]:
+        return np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+    started = time.perf_counter()
+    embeddings = encode(embed_model, [chunk["text"] for chunk in plan["new_chunks"]])
+    _record_cost("embed", time.perf_counter() - started, len(embeddings))
+    return embeddings
+
+def embed_document(plan, embed_model):
+    """
+    Build the embedding matrix of every chunk in a plan, in chunk order.
+
+    Vectors already in the index are fetched rather than re-embedded,
+    unless fetching has been measured to cost more per vector than
+    embedding (e.g. a remote index over a slow link), in which case the
+    whole document is embedded locally. Chunks that are new, or whose
+    vectors are missing from the index, are embedded now and recorded in
+    the plan's ``new_chunks``. Returns the full matrix and the embeddings
+    of ``new_chunks`` for apply_plan.
+    """
+    chunks = plan["chunks"]
+    new_ids = {chunk["id"] for chunk in plan["new_chunks"]}
+    stored_ids = [chunk["id"] for chunk in chunks if chunk["id"] not in new_ids]
+
+    fetch_cost, embed_cost = _vector_costs["fetch"], _vector_costs["embed"]
+    probe = next(_documents_embedded) % FETCH_PROBE_INTERVAL == 0
+    if stored_ids and not probe and fetch_cost is not None and embed_cost is not None and fetch_cost > embed_cost:
+        # Cheaper to embed the whole document than to fetch its vectors
+        started = time.perf_counter()
+        matrix = encode(embed_model, [chunk["text"] for chunk in chunks])
+        _record_cost("embed", time.perf_counter() - started, len(chunks))
+        rows = [row for row, chunk in enumerate(chunks) if chunk["id"] in new_ids]
+        return matrix, matrix[rows]
+
+    stored = {}
+    if stored_ids:
+        started = time.perf_counter()
+        stored = index.fetch(stored_ids)
+        _record_cost("fetch", time.perf_counter() - started, len(stored_ids))
+
+    missing = [chunk for chunk in chunks if chunk["id"] not in new_ids and chunk["id"] not in stored]
+    plan["new_chunks"] = plan["new_chunks"] + missing
+    embeddings = embed_plan(plan, embed_model)
+    fresh = {chunk["id"]: row for row, chunk in enumerate(plan["new_chunks"])}
+
+    matrix = np.empty((len(chunks), EMBEDDING_DIM), dtype=np.float32)
+    for row, chunk in enumerate(chunks):
+        if chunk["id"] in fresh:
+            matrix[row] = embeddings[fresh[chunk["id"]]]
+        else:
+            matrix[row] = stored[chunk["id"]]
+    return matrix, embeddings
+
+def apply_plan(plan, embeddings):
+    """
+    Write an embedded ingest plan to the vector index and document store.
+
+    Callers in one process serialise plan -> apply per document (see
+    ``ingest.document_lock``). The chunks to delete are still read back
+    from the document store here rather than taken from the plan, so a
+    version written by another process since the plan was made does not
+    leave orphaned vectors behind.
+    """
+    if plan["unchanged"] and not plan["new_chunks"]:
+        return plan["document_id"]
+
+    # Vectors first, then the document row: if upserting fails the stored
+    # version is unchanged and the next attempt recomputes the same diff.
+    if plan["new_chunks"]:
+        upsert_chunks([chunk["id"] for chunk in plan["new_chunks"]], embeddings)
+
+    current_ids = {chunk["id"] for chunk in plan["chunks"]}
+    plan["removed_ids"] = [
+        chunk_id for chunk_id in db.get_chunk_ids(plan["document_id"]) if chunk_id not in current_ids
+    ]
+    db.save_document(
+        plan["document_id"], plan["source"], plan["content_hash"], plan["page_count"], plan["chunks"]
+    )
+    delete_chunks(plan["removed_ids"])
+    return plan["document_id"]
+
+def apply_document(plan, matrix):
+    """
+    Write a plan whose every chunk is embedded in ``matrix`` (as returned
+    by embed_document), diffing it again first: another request may have
+    stored a different version of the document since the plan was made,
+    and the full matrix covers whatever the new diff needs.
+    """
+    embedded_ids = {chunk["id"] for chunk in plan["new_chunks"]}
+    diff_plan(plan)
+    needed_ids = embedded_ids | {chunk["id"] for chunk in plan["new_chunks"]}
+    rows = [row for row, chunk in enumerate(plan["chunks"]) if chunk["id"] in needed_ids]
+    plan["new_chunks"] = [plan["chunks"][row] for row in rows]
+    return apply_plan(plan, matrix[rows])
+
+def embed_and_upsert(pages, embed_model, source="unknown"):
+    """
+    Split, embed and upsert a document's chunks.
+
+    Chunk text and offsets go to the local document store; the vector index
+    only receives chunk ids. When a document is re-submitted, only new
+    chunks are embedded and upserted, and chunks that disappeared are
+    deleted. Returns the document id.
+    """
+    plan = plan_ingest(pages, source)
+    if plan["unchanged"]:
+        return plan["document_id"]
+    return apply_plan(plan, embed_plan(plan, embed_model))
+
+def encode(embed_model, texts):
+    """
+    Embed texts into a contiguous float32 matrix, one row per text.
+    """
+    embeddings = embed_model.encode(texts, convert_to_numpy=True)
+    return np.ascontiguousarray(embeddings, dtype=np.float32)
+
+def upsert_chunks(chunk_ids, embeddings):
+    """
+    Upsert a matrix of chunk embeddings into the configured vector index.
+    """
+    index.upsert(chunk_ids, np.ascontiguousarray(embeddings, dtype=np.float32))
     return index
 
+def delete_chunks(chunk_ids, batch_size=1000):
+    """
+    Remove chunk vectors from the configured vector index.
+    """
+    for i in range(0, len(chunk_ids), batch_size):
+        index.delete(chunk_ids[i:i + batch_size])
+
+def purge_legacy_chunks():
+    """
+    Delete vectors written under the original ``chunk-{i}`` id scheme.
+
+    They have no document-store row, so ``search`` cannot hydrate them and
+    they only push real chunks out of the top k. Content-hash ids never
+    start with the legacy prefix. Returns the number of vectors deleted.
+    """
+    if VECTOR_BACKEND != "pinecone":
+        # The local index never held legacy ids
+        return 0
+    legacy_ids = index.list_ids(LEGACY_ID_PREFIX)
+    delete_chunks(legacy_ids)
+    return len(legacy_ids)
+
 def search(query_vector, top_k=5):
     """
-    Search Pinecone index with query vector.
+    Search the configured vector index with query vector and hydrate the
+    matching chunk text from the document store.
     """
-    results = index.query(vector=query_vector, top_k=top_k, include_metadata=True)
-    return [match['metadata']['text'] for match in results['matches']]
+    results = index.query(query_vector, top_k=top_k)
+    return db.get_chunk_texts([match['id'] for match in results['matches']])
+
+if __name__ == "__main__":
+    import sys
+
+    # One-off migration: python vector_store.py purge-legacy
+    if sys.argv[1:] == ["purge-legacy"]:
+        print(f"Deleted {purge_legacy_chunks()} legacy vectors")
+    else:
+        print("Usage: python vector_store.py purge-legacy")